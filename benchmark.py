@@ -0,0 +1,293 @@
+import pandas as pd
+import spatialpandas as spd
+from spatialpandas.geometry import PointArray
+import geopandas as gpd
+import shapely
+import rioxarray
+import numpy as np
+import xarray as xr
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import landscan_census as lc
+import landscan_svi_merge as lsm
+
+
+# raster edge lengths (in 3 arcsecond cells) of the synthetic state at each benchmark size
+BENCHMARK_SIZES = {'small': 200, 'medium': 600, 'large': 1500}
+
+# 3 arcsecond LandScan cells
+RESOLUTION = 3 / 3600
+
+# synthetic tracts are an evenly spaced grid of boxes, this many along each side of the raster
+TRACTS_PER_SIDE = 8
+
+# demographics variables of the SQLite fixture and their display_data units, as in the project database
+FIXTURE_VARIABLES = {
+    'TOTPOP': 'persons',
+    'HH': 'households',
+    'HU': 'housing units',
+    'TOTAL_COMMUTE_POP': 'persons commuting',
+    'E_POV': 'persons',
+    'E_UNEMP': 'persons',
+    'E_NOVEH': 'households',
+    'E_MUNIT': 'housing structures',
+    'PCI': 'dollars',
+    'MEDIAN_GROSS_RENT_PCT_HH_INCOME': 'dollars',
+}
+
+
+def synthetic_rasters(size, seed=0, chunk_size=500):
+    """
+    Deterministic night and day population rasters of size x size 3 arcsecond cells, shaped like the rioxarray
+    rasters from load_landscan: masked (NaN) nodata along one edge, dask chunks, EPSG:4326
+    """
+
+    rng = np.random.default_rng(seed)
+    x = -100 + RESOLUTION * (np.arange(size) + 0.5)
+    y = 32 - RESOLUTION * (np.arange(size) + 0.5)
+
+    rasters = []
+    for scale in (5.0, 8.0):
+        values = rng.gamma(0.3, scale, (1, size, size)).astype('float32')
+        values[:, :, :size // 10] = np.nan
+        raster = xr.DataArray(values, dims=('band', 'y', 'x'), coords=dict(band=[1], y=y, x=x))
+        raster = raster.rio.write_crs('EPSG:4326').chunk({'x': chunk_size, 'y': chunk_size})
+        rasters.append(raster)
+
+    return tuple(rasters)
+
+
+def synthetic_tracts(raster, tracts_per_side=TRACTS_PER_SIDE):
+    """
+    Tract polygons tiling the raster extent on a known grid, with Texas-style GEOIDs
+    """
+
+    xmin, ymin, xmax, ymax = raster.rio.bounds()
+    x_edges = np.linspace(xmin, xmax, tracts_per_side + 1)
+    y_edges = np.linspace(ymin, ymax, tracts_per_side + 1)
+    x0, y0 = np.meshgrid(x_edges[:-1], y_edges[:-1], indexing='ij')
+    x1, y1 = np.meshgrid(x_edges[1:], y_edges[1:], indexing='ij')
+
+    return gpd.GeoDataFrame(
+        {'GEOID': ['48{:09d}'.format(i) for i in range(x0.size)]},
+        geometry=shapely.box(x0.ravel(), y0.ravel(), x1.ravel(), y1.ravel()),
+        crs='EPSG:4326'
+    )
+
+
+def synthetic_database(path, geoids, years=('2019', ), seed=0):
+    """
+    SQLite fixture with the demographics and display_data tables queried by AnnualSVI
+    """
+
+    rng = np.random.default_rng(seed)
+    if os.path.exists(path):
+        os.remove(path)
+
+    rows = []
+    for year in years:
+        for geoid in geoids:
+            total = float(rng.integers(1000, 8000))
+            for name, units in FIXTURE_VARIABLES.items():
+                if name == 'TOTPOP':
+                    value = total
+                elif units == 'dollars':
+                    value = float(rng.integers(10, 60000))
+                else:
+                    value = float(rng.integers(0, total))
+                rows.append(dict(GEOID=geoid, YEAR=int(year), GEOTYPE='tract', UNITS='count',
+                                 DEMOGRAPHICS_NAME=name, VALUE=value))
+
+    conn = sqlite3.connect(path)
+    pd.DataFrame({'NAME': list(FIXTURE_VARIABLES), 'UNITS': list(FIXTURE_VARIABLES.values())}).to_sql(
+        'display_data', conn, index=False)
+    pd.DataFrame(rows).to_sql('demographics', conn, index=False)
+    conn.close()
+
+
+def synthetic_landscan_join(path, joined):
+    """
+    Write LandScan cells joined to tracts (x, y, GEOID, average_population) as the spatialpandas parquet that
+    AnnualSVI reads
+    """
+
+    cells = joined[['x', 'y', 'GEOID', 'average_population']].copy()
+    cells['GEOID'] = cells['GEOID'].astype(str)
+    cells['geometry'] = PointArray(np.column_stack([cells['x'].values, cells['y'].values]))
+    spd.GeoDataFrame(cells).to_parquet(path)
+
+
+def measure(fxn, repeat=1):
+    """
+    Best wall time of `repeat` calls to fxn, then the peak traced allocation (numpy included) of one more call. An
+    untimed first call keeps numba compilation and dask graph setup out of the numbers.
+    """
+
+    fxn()
+    seconds = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fxn()
+        seconds.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    fxn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return dict(seconds=min(seconds), peak_bytes=peak)
+
+
+def run_benchmarks(sizes, workdir, repeat=1, ncpu=2):
+    """
+    Time and memory-profile every pipeline stage on synthetic data at each size, returning
+    {'<stage>[<size>]': {'seconds': ..., 'peak_bytes': ...}}
+    """
+
+    results = {}
+    counter = iter(range(10 ** 6))
+
+    def record(stage, size_name, fxn):
+        name = '{}[{}]'.format(stage, size_name)
+        results[name] = measure(fxn, repeat)
+        print('{:45s} {:9.3f} s {:10.1f} MB'.format(name, results[name]['seconds'], results[name]['peak_bytes'] / 1e6))
+
+    for size_name in sizes:
+        size = BENCHMARK_SIZES[size_name]
+        size_dir = os.path.join(workdir, size_name)
+        os.makedirs(size_dir, exist_ok=True)
+
+        night, day = synthetic_rasters(size)
+        tracts = synthetic_tracts(night)
+        ll = lc.Landscan(night_raster=night, day_raster=day, shp=tracts)
+
+        def average_population():
+            ll.average_population()
+            ll.average_raster = ll.average_raster.persist()
+        record('average_population', size_name, average_population)
+
+        record('dask_spatial_sort', size_name, lambda: ll.dask_spatial_sort(
+            savepath=os.path.join(size_dir, 'sorted_{}.parquet'.format(next(counter)))))
+
+        def spatialpandas_sjoin():
+            ll.gpd_to_spd()
+            spd.sjoin(ll.average_raster_dask, ll.spdf, how='inner').compute()
+        record('sjoin', size_name, spatialpandas_sjoin)
+
+        def zone_index():
+            # zone_join reuses ll.zones, so rasterize the tracts afresh on every call
+            ll.zones = None
+            ll.zone_index()
+        record('zone_index', size_name, zone_index)
+
+        record('zone_join', size_name, lambda: ll.zone_join())
+
+        window_size = 10
+        population = ll.average_raster['average_population'].squeeze(drop=True).transpose('x', 'y').compute()
+        population = population.rio.write_crs('EPSG:4326')
+        square_raster = lc.make_divisible_square_extent(population, lc.merge_datasets, multiple=window_size * 10)
+        chunk_size = square_raster.rio.height // 2 if square_raster.rio.height % 2 == 0 else square_raster.rio.height
+        chunk_size -= chunk_size % window_size
+        reducer = lc.ReduceRaster(square_raster, window_size=window_size, chunk_size=chunk_size)
+        record('reduce_raster_resolution', size_name,
+               lambda: reducer.reduce_raster_resolution(ncpu=ncpu, backend='thread'))
+
+        reduced = reducer.reduce_raster_resolution(ncpu=ncpu, backend='thread')
+        record('fishnet', size_name, lambda: lc.fishnet(reduced))
+
+        landscan_path = os.path.join(size_dir, 'landscan_join.parquet')
+        db_path = os.path.join(size_dir, 'demographics.db')
+        joined = ll.zone_join(layers=('average_population', ))
+        synthetic_landscan_join(landscan_path, joined)
+        synthetic_database(db_path, tracts['GEOID'])
+        annual = lsm.AnnualSVI(db_path, landscan_path, '2019', os.path.join(size_dir, '{}_{}.nc'))
+
+        record('annual_landscan_weight', size_name, annual.annual_landscan_weight)
+
+        def svi_xarray():
+            for path in os.listdir(size_dir):
+                if path.endswith('.nc'):
+                    os.remove(os.path.join(size_dir, path))
+            annual.svi_xarray(svi_column='E_POV', total_column='TOTPOP')
+        record('svi_xarray', size_name, svi_xarray)
+
+    return results
+
+
+def compare(results, baseline, time_tolerance=0.25, memory_tolerance=0.10):
+    """
+    Stages slower or larger than the baseline by more than the given fractions
+    """
+
+    regressions = []
+    for stage, measured in sorted(results.items()):
+        if stage not in baseline['results']:
+            continue
+        expected = baseline['results'][stage]
+        if measured['seconds'] > expected['seconds'] * (1 + time_tolerance):
+            regressions.append('{}: {:.3f} s vs baseline {:.3f} s'.format(
+                stage, measured['seconds'], expected['seconds']))
+        if measured['peak_bytes'] > expected['peak_bytes'] * (1 + memory_tolerance):
+            regressions.append('{}: {:.1f} MB vs baseline {:.1f} MB'.format(
+                stage, measured['peak_bytes'] / 1e6, expected['peak_bytes'] / 1e6))
+
+    return regressions
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description='benchmark every pipeline stage on synthetic data')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=list(BENCHMARK_SIZES),
+                        help='synthetic raster sizes to run')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='timed calls per stage (the best is kept)')
+    parser.add_argument('-n', '--ncpu', type=int, default=2, help='workers for the parallel stages')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-b', '--baseline', help='baseline JSON file to compare against')
+    parser.add_argument('--save_baseline', action='store_true', help='write the results to --baseline instead')
+    parser.add_argument('--time_tolerance', type=float, default=0.25, help='allowed fractional slowdown')
+    parser.add_argument('--memory_tolerance', type=float, default=0.10, help='allowed fractional memory growth')
+    parser.add_argument('--workdir', help='directory for the synthetic inputs (default: a temporary directory)')
+
+    opts = parser.parse_args()
+
+    workdir = opts.workdir or tempfile.mkdtemp(prefix='landscan_benchmark_')
+    try:
+        results = run_benchmarks(opts.sizes, workdir, repeat=opts.repeat, ncpu=opts.ncpu)
+    finally:
+        if opts.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = dict(
+        python=sys.version.split()[0],
+        platform=platform.platform(),
+        processor=platform.processor(),
+        sizes={s: BENCHMARK_SIZES[s] for s in opts.sizes},
+        results=results
+    )
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if opts.baseline and opts.save_baseline:
+        with open(opts.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Saved baseline {}'.format(opts.baseline))
+    elif opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, opts.time_tolerance, opts.memory_tolerance)
+        if regressions:
+            print('PERFORMANCE REGRESSIONS against {}:'.format(opts.baseline))
+            for regression in regressions:
+                print('  ' + regression)
+            sys.exit(1)
+        print('No regressions against {}'.format(opts.baseline))
@@ -0,0 +1,174 @@
+import pandas as pd
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+
+
+# columns used to filter the demographics table, indexed in the local copy of the database
+DEMOGRAPHICS_INDEX_COLUMNS = ['YEAR', 'GEOTYPE', 'UNITS', 'DEMOGRAPHICS_NAME']
+
+
+class DemographicsDB:
+    """
+    Access to the demographics and display_data tables of the project SQLite database.
+
+    Queries are parameterized. With a cache_dir, the database is copied there once, and the copy is indexed on
+    (YEAR, GEOTYPE, UNITS, DEMOGRAPHICS_NAME). Each per-year, per-geotype wide (pivoted) table is saved as a
+    Parquet extract, so repeat runs skip SQLite and the pivot entirely. The copy and the extracts are refreshed
+    when the database file changes. Without a cache_dir, the database is opened read-only and nothing is cached.
+    """
+
+    def __init__(self, db_path, cache_dir=None):
+        self.db_path = db_path
+        self.cache_dir = cache_dir
+        self.fingerprint = database_fingerprint(db_path)
+
+        if cache_dir is None:
+            self.conn = sqlite3.connect('file:{}?mode=ro'.format(db_path), uri=True)
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.conn = sqlite3.connect(self.local_copy())
+
+    def local_copy(self):
+        """
+        Path of the indexed local copy of the database, (re)creating it if the source database has changed. The
+        source fingerprint is part of the file name, so a copy is never paired with the wrong version.
+        """
+
+        root, ext = os.path.splitext(os.path.basename(self.db_path))
+        copy_prefix = '{}_copy_'.format(root)
+        copy_path = os.path.join(self.cache_dir, '{}{}{}'.format(copy_prefix, self.fingerprint, ext))
+        if os.path.exists(copy_path):
+            return copy_path
+
+        # copy a consistent snapshot into a private temporary file and move it into place, so jobs sharing the
+        # cache directory never write the same file
+        fd, tmp_path = tempfile.mkstemp(prefix='.{}.'.format(root), suffix='.tmp', dir=self.cache_dir)
+        os.close(fd)
+        try:
+            source = sqlite3.connect('file:{}?mode=ro'.format(self.db_path), uri=True)
+            local = sqlite3.connect(tmp_path)
+            source.backup(local)
+            source.close()
+
+            local.execute('create index if not exists demographics_filter on demographics ({})'.format(
+                ', '.join(DEMOGRAPHICS_INDEX_COLUMNS)))
+            local.execute('create index if not exists display_data_name on display_data (NAME)')
+            local.commit()
+            local.close()
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, copy_path)
+        except BaseException:
+            remove_if_exists(tmp_path)
+            raise
+
+        # copies of earlier versions of the database; open connections keep reading a removed copy
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(copy_prefix) and name.endswith(ext) and name != os.path.basename(copy_path):
+                remove_if_exists(os.path.join(self.cache_dir, name))
+
+        return copy_path
+
+    def close(self):
+        self.conn.close()
+
+    def display_data(self):
+
+        return pd.read_sql_query('select * from display_data;', self.conn)
+
+    def long_table(self, year, geotype, units=None, display_units=None, names=None):
+        """
+        Rows of demographics joined to display_data for one year and geotype, optionally restricted to a
+        demographics UNITS value, a list of display_data UNITS and/or a list of DEMOGRAPHICS_NAME values
+        """
+
+        clauses = ['d.YEAR = ?', 'd.GEOTYPE = ?']
+        params = [year, geotype]
+        if units is not None:
+            clauses.append('d.UNITS = ?')
+            params.append(units)
+        if display_units is not None:
+            clauses.append('dd.UNITS in ({})'.format(', '.join('?' for _ in display_units)))
+            params.extend(display_units)
+        if names is not None:
+            clauses.append('d.DEMOGRAPHICS_NAME in ({})'.format(', '.join('?' for _ in names)))
+            params.extend(names)
+
+        query = """select * from demographics d
+            join display_data dd on d.DEMOGRAPHICS_NAME = dd.NAME
+            where {}
+            """.format(' and '.join(clauses))
+
+        return pd.read_sql_query(query, self.conn, params=params)
+
+    def wide_table(self, year, geotype, units=None, display_units=None, names=None):
+        """
+        long_table pivoted to one row per GEOID and one column per DEMOGRAPHICS_NAME, read from the Parquet
+        extract when one exists for the current database file
+        """
+
+        filters = dict(year=str(year), geotype=geotype, units=units, display_units=display_units, names=names)
+
+        extract_path = None
+        if self.cache_dir is not None:
+            extract_path = self.extract_path(filters)
+            if os.path.exists(extract_path):
+                return pd.read_parquet(extract_path)
+
+        long_df = self.long_table(year, geotype, units=units, display_units=display_units, names=names)
+        wide_df = pd.pivot(long_df, index='GEOID', columns='DEMOGRAPHICS_NAME', values='VALUE').reset_index()
+        wide_df.columns.name = None
+
+        if extract_path is not None:
+            self.remove_stale_extracts(filters)
+            fd, tmp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=self.cache_dir)
+            os.close(fd)
+            try:
+                wide_df.to_parquet(tmp_path, index=False)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, extract_path)
+            except BaseException:
+                remove_if_exists(tmp_path)
+                raise
+
+        return wide_df
+
+    def extract_prefix(self, filters):
+        filters_hash = hashlib.sha1(json.dumps(filters, sort_keys=True).encode()).hexdigest()[:12]
+        return '{}_{}_{}_'.format(filters['geotype'], filters['year'], filters_hash)
+
+    def extract_path(self, filters):
+        return os.path.join(self.cache_dir, '{}{}.parquet'.format(self.extract_prefix(filters), self.fingerprint))
+
+    def remove_stale_extracts(self, filters):
+        """
+        Delete extracts of the same table built from an earlier version of the database file
+        """
+
+        prefix = self.extract_prefix(filters)
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix) and name.endswith('.parquet'):
+                remove_if_exists(os.path.join(self.cache_dir, name))
+
+
+def database_fingerprint(db_path):
+    """
+    Identifies a version of the database file by its size and modification time
+    """
+
+    stat = os.stat(db_path)
+
+    return '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def remove_if_exists(path):
+    """
+    Remove a file that another job sharing the cache directory may already have removed
+    """
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
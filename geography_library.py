@@ -0,0 +1,215 @@
+import geopandas as gpd
+import numpy as np
+import pyarrow.parquet as pq
+import json
+import logging
+import os
+
+
+# per-row bounding box columns written next to the geometry, used for bbox predicate pushdown
+BBOX_COLUMNS = ['minx', 'miny', 'maxx', 'maxy']
+
+# column holding the state FIPS code in TIGER layers that nest within states
+STATE_COLUMN = 'STATEFP'
+
+
+class GeographyLibrary:
+    """
+    Local library of TIGER geographies (states, counties, tracts, ZCTAs, CBSAs, congressional districts, ...).
+    Each (layer, vintage) is converted once from its shapefile into GeoParquet, reprojected to one CRS and written
+    with bbox columns. Rows are sorted by state and then by a Z-order key of their bbox centers, and written in
+    small row groups. A saved index of each row group's bbox and states lets load() read only the row groups that
+    can match a state FIPS code or bounding box, so a Texas run never decodes the rest of the country.
+    path: library directory, holding <layer>/<vintage>.parquet and <layer>/<vintage>.index.json
+    crs: CRS every layer is stored in
+    """
+
+    def __init__(self, path, crs='EPSG:4326', row_group_size=1000):
+        self.path = path
+        self.crs = crs
+        self.row_group_size = row_group_size
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, layer, vintage):
+        return os.path.join(self.path, layer, '{}.parquet'.format(vintage))
+
+    def index_path(self, layer, vintage):
+        return os.path.join(self.path, layer, '{}.index.json'.format(vintage))
+
+    def layers(self):
+        """
+        {layer: [vintages]} of every converted layer
+        """
+
+        layers = {}
+        for layer in sorted(os.listdir(self.path)):
+            layer_dir = os.path.join(self.path, layer)
+            if os.path.isdir(layer_dir):
+                layers[layer] = sorted(f[:-len('.index.json')] for f in os.listdir(layer_dir)
+                                       if f.endswith('.index.json'))
+
+        return layers
+
+    def read_index(self, layer, vintage):
+
+        with open(self.index_path(layer, vintage)) as f:
+            return json.load(f)
+
+    def is_current(self, layer, vintage, source):
+        """
+        True if (layer, vintage) was converted from source and source has not changed since
+        """
+
+        if not os.path.exists(self.index_path(layer, vintage)):
+            return False
+        index = self.read_index(layer, vintage)
+
+        return index['source'] == source and index['source_mtime'] == os.path.getmtime(source)
+
+    def add(self, layer, vintage, source, id_column='GEOID', overwrite=False):
+        """
+        Convert a shapefile (or any file gpd.read_file reads, or a GeoDataFrame) into the library, unless the same
+        unchanged source was already converted
+        """
+
+        if isinstance(source, str) and not overwrite and self.is_current(layer, vintage, source):
+            logging.info(f'Geography {layer} {vintage} is up to date')
+            return
+
+        geo_df = gpd.read_file(source) if isinstance(source, str) else source
+        if geo_df.crs is not None and geo_df.crs != self.crs:
+            geo_df = geo_df.to_crs(self.crs)
+        geo_df = geo_df[geo_df.geometry.notna() & ~geo_df.geometry.is_empty]
+
+        bounds = geo_df.geometry.bounds.values
+        geo_df = geo_df.assign(**{c: bounds[:, i] for i, c in enumerate(BBOX_COLUMNS)})
+
+        # state first (for layers that have one), then spatial order, so row groups are compact in both
+        geo_df = geo_df.assign(_zorder=zorder_key((bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2))
+        sort_columns = [STATE_COLUMN, '_zorder'] if STATE_COLUMN in geo_df.columns else ['_zorder']
+        geo_df = geo_df.sort_values(sort_columns, kind='stable').drop(columns='_zorder').reset_index(drop=True)
+
+        os.makedirs(os.path.join(self.path, layer), exist_ok=True)
+        entry_path = self.entry_path(layer, vintage)
+        geo_df.to_parquet(entry_path + '.tmp', index=False, row_group_size=self.row_group_size)
+        os.replace(entry_path + '.tmp', entry_path)
+
+        row_groups = []
+        for start in range(0, len(geo_df), self.row_group_size):
+            group = geo_df.iloc[start:start + self.row_group_size]
+            row_groups.append(dict(
+                bbox=[float(group['minx'].min()), float(group['miny'].min()),
+                      float(group['maxx'].max()), float(group['maxy'].max())],
+                states=sorted(group[STATE_COLUMN].astype(str).unique()) if STATE_COLUMN in group.columns else None
+            ))
+        index = dict(
+            layer=layer,
+            vintage=vintage,
+            crs=str(self.crs),
+            id_column=id_column,
+            source=source if isinstance(source, str) else None,
+            source_mtime=os.path.getmtime(source) if isinstance(source, str) else None,
+            rows=len(geo_df),
+            row_groups=row_groups
+        )
+        with open(self.index_path(layer, vintage), 'w') as f:
+            json.dump(index, f)
+
+        logging.info(f'Added geography {layer} {vintage}: {len(geo_df)} rows in {len(row_groups)} row groups')
+
+    def load(self, layer, vintage, state=None, bbox=None, columns=None, clip=None):
+        """
+        Load a layer, reading only the row groups that can match the filters
+        state: state FIPS code (e.g. '48') or list of codes; layers without a STATEFP column (ZCTAs, CBSAs, ...) are
+            filtered by the bbox of the state from the library's "state" layer of the same vintage
+        bbox: (minx, miny, maxx, maxy) in the library CRS; rows whose bbox overlaps it are kept
+        columns: attribute columns to read (all if None)
+        clip: 'intersects' or 'within' to keep only rows with that relation to the state geometries, as in the
+            shape_mask notebook helper; by default rows are filtered on bboxes only
+        """
+
+        index = self.read_index(layer, vintage)
+        states = [state] if isinstance(state, str) else state
+        by_state_column = bool(states is not None and index['row_groups'] and
+                               index['row_groups'][0]['states'] is not None)
+
+        state_shapes = None
+        if states is not None and (not by_state_column or clip is not None):
+            state_shapes = self.load('state', vintage, state=states)
+            bbox = intersect_bboxes(bbox, tuple(state_shapes.total_bounds))
+
+        groups = []
+        for i, group in enumerate(index['row_groups']):
+            if by_state_column and not set(group['states']) & set(states):
+                continue
+            if bbox is not None and not bboxes_overlap(group['bbox'], bbox):
+                continue
+            groups.append(i)
+
+        parquet_file = pq.ParquetFile(self.entry_path(layer, vintage))
+        if columns is not None:
+            read_columns = list(dict.fromkeys(list(columns) + [STATE_COLUMN] * by_state_column + BBOX_COLUMNS +
+                                              ['geometry']))
+        else:
+            read_columns = None
+        table = parquet_file.read_row_groups(groups, columns=read_columns)
+
+        attributes = table.drop(['geometry']).to_pandas()
+        geometry = gpd.GeoSeries.from_wkb(table.column('geometry').to_numpy(zero_copy_only=False), crs=index['crs'])
+        geo_df = gpd.GeoDataFrame(attributes, geometry=geometry, crs=index['crs'])
+
+        keep = np.ones(len(geo_df), dtype=bool)
+        if by_state_column:
+            keep &= geo_df[STATE_COLUMN].astype(str).isin(states).values
+        if bbox is not None:
+            keep &= ((geo_df['maxx'] >= bbox[0]) & (geo_df['minx'] <= bbox[2]) &
+                     (geo_df['maxy'] >= bbox[1]) & (geo_df['miny'] <= bbox[3])).values
+        geo_df = geo_df[keep].reset_index(drop=True)
+
+        if clip is not None and state_shapes is not None:
+            masked = gpd.sjoin(geo_df, state_shapes[['geometry']], predicate=clip, how='inner')
+            geo_df = geo_df.loc[masked.index.unique()].reset_index(drop=True)
+
+        if columns is not None:
+            # the state and bbox columns were only read for filtering
+            geo_df = geo_df.drop(columns=[c for c in read_columns if c not in columns and c != 'geometry'])
+
+        logging.info(f'Loaded {len(geo_df)} {layer} {vintage} rows from {len(groups)} of '
+                     f'{len(index["row_groups"])} row groups')
+
+        return geo_df
+
+
+def zorder_key(x, y, bits=16):
+    """
+    Z-order (Morton) key of points, quantized to 2**bits steps over their extent
+    """
+
+    keys = np.zeros(len(x), dtype=np.uint64)
+    if len(x) == 0:
+        return keys
+
+    scaled = []
+    for values in (np.asarray(x, dtype=float), np.asarray(y, dtype=float)):
+        low, high = np.nanmin(values), np.nanmax(values)
+        span = high - low if high > low else 1.0
+        scaled.append(np.clip((values - low) / span * (2 ** bits - 1), 0, 2 ** bits - 1).astype(np.uint64))
+
+    for bit in range(bits):
+        keys |= ((scaled[0] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit)
+        keys |= ((scaled[1] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit + 1)
+
+    return keys
+
+
+def bboxes_overlap(a, b):
+
+    return a[2] >= b[0] and a[0] <= b[2] and a[3] >= b[1] and a[1] <= b[3]
+
+
+def intersect_bboxes(a, b):
+
+    if a is None:
+        return b
+
+    return max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])
@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class StageMetrics:
+    """
+    Records wall time, CPU time, RSS and rows/cells processed for each pipeline stage and appends one JSON line
+    per stage. Pipeline code opens stages with the module-level stage(); configure() turns recording on for a run.
+    path: JSON lines file the records are appended to; with None, records are written to stderr instead
+    profile: stage names to run under a dask performance report, or True for every stage
+    report_dir: directory for the performance report HTML files
+    context: fields added to every record, e.g. run='tx_2019'
+    """
+
+    def __init__(self, path=None, profile=None, report_dir=None, **context):
+        self.path = path
+        self.profile = profile
+        self.report_dir = report_dir if report_dir is not None else os.getcwd()
+        self.context = context
+        self.lock = threading.Lock()
+        self.active = 0
+
+    def profiling(self, name):
+
+        return self.profile is True or (self.profile is not None and name in self.profile)
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """
+        Measure the enclosed block as stage name. Yields the record dict so the block can add rows, cells or any
+        other field before it is written.
+        """
+
+        record = dict(self.context, stage=name, **fields)
+        with self.lock:
+            # the process peak RSS can only be reset when no other stage (e.g. another variable thread) is running
+            concurrent = self.active
+            record['peak_rss_since'] = 'stage' if concurrent == 0 and reset_peak_rss() else 'process'
+            self.active += 1
+
+        report = self.performance_report(name, record) if self.profiling(name) else nullcontext()
+        start = time.time()
+        wall0 = time.perf_counter()
+        cpu0 = time.process_time()
+        rss0 = current_rss()
+        status = 'ok'
+        try:
+            with report:
+                yield record
+        except BaseException as e:
+            status = type(e).__name__
+            raise
+        finally:
+            with self.lock:
+                self.active -= 1
+            record.update(
+                status=status,
+                start=start,
+                wall_seconds=time.perf_counter() - wall0,
+                cpu_seconds=time.process_time() - cpu0,
+                rss_start_bytes=rss0,
+                rss_end_bytes=current_rss(),
+                peak_rss_bytes=peak_rss(),
+                concurrent_stages=concurrent,
+                pid=os.getpid()
+            )
+            self.emit(record)
+
+    def emit(self, record):
+
+        line = json.dumps(record, default=str)
+        if self.path is None:
+            # stderr rather than logging, which drops INFO records unless the caller configured a handler
+            with self.lock:
+                print(line, file=sys.stderr, flush=True)
+            return
+        # one write per line in append mode, so forked year workers can share the file
+        with self.lock, open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+    def performance_report(self, name, record):
+        """
+        dask performance report context for stage name, if dask.distributed and bokeh are installed and a client is
+        running
+        """
+
+        try:
+            from dask.distributed import default_client, performance_report
+            import bokeh
+            default_client()
+        except ImportError:
+            logging.warning(f'dask.distributed and bokeh are needed for the performance report of stage {name}')
+            return nullcontext()
+        except ValueError:
+            logging.warning(f'No dask distributed client; skipping the performance report for stage {name}')
+            return nullcontext()
+
+        filename = os.path.join(self.report_dir, '{}_{}_{}.html'.format(name, os.getpid(), int(time.time())))
+        record['performance_report'] = filename
+
+        return performance_report(filename=filename)
+
+
+# recorder used by stage(); None until configure() is called, so unconfigured runs pay nothing
+_metrics = None
+
+
+def configure(path=None, profile=None, report_dir=None, **context):
+    """
+    Turn on stage recording for this process (and the workers it forks); see StageMetrics for the arguments
+    """
+
+    global _metrics
+    _metrics = StageMetrics(path=path, profile=profile, report_dir=report_dir, **context)
+
+    return _metrics
+
+
+def disable():
+
+    global _metrics
+    _metrics = None
+
+
+def stage(name, **fields):
+    """
+    Context manager measuring the enclosed block as stage name, yielding its record dict; a no-op (yielding a
+    plain dict) unless configure() has been called
+    """
+
+    if _metrics is None:
+        return nullcontext(dict(fields))
+
+    return _metrics.stage(name, **fields)
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes, or None where /proc is not available
+    """
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes since it started or since the last reset_peak_rss()
+    """
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS, and cannot be reset
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS to the current RSS (Linux only); returns whether it was reset
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
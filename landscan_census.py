@@ -2,16 +2,28 @@ import pandas as pd
 import spatialpandas as spd
 from spatialpandas.geometry import PointArray
 import geopandas as gpd
-from shapely.geometry import Polygon
+import shapely
 import rioxarray
+import rasterio
+from rasterio import features, windows
 import numpy as np
 import xarray as xr
 import matplotlib.pyplot as plt
+import dask
+import dask.array as da
+import hashlib
 import math
 import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os
+import shutil
+import tempfile
 import time
 import logging
-logging.basicConfig(level=logging.DEBUG)
+
+import instrumentation
 
 
 ###############
@@ -23,36 +35,146 @@ logging.basicConfig(level=logging.DEBUG)
 # - https://www.quansight.com/post/spatial-filtering-at-scale-with-dask-and-spatialpandas
 # package `spatialpandas` is CRS-agnostic, so any pre-join CRS manipulations must be done with geopandas
 
-def floor_integer(xarray):
+def floor_integer(xarray, dtype='int'):
     """
     Cast float type xarray.DataArray with one variable to integer, taking the floor of the float values first.
     Produces the same result as directly casting to integer for values already close to their floor, but is
     more transparent and deliberate about value handling.
     """
 
-    xarray_floor = xr.ufuncs.floor(xarray)
+    xarray_floor = np.floor(xarray)
     xarray_floor = xarray_floor.fillna(0)
-    xarray_floor = xarray_floor.astype('int')
+    xarray_floor = xarray_floor.astype(dtype)
 
     return xarray_floor
 
 
-def load_landscan(night_path, day_path):
+def load_landscan(night_path, day_path, clip=None, chunk_size=1000):
+    """
+    Open the night and day LandScan GeoTIFFs as dask-backed DataArrays. Chunks are whole multiples of each file's
+    internal block shape, about chunk_size cells on a side. With clip (a GeoDataFrame such as Landscan.shp, a
+    shapely geometry or a (minx, miny, maxx, maxy) tuple in the raster CRS), only the block-aligned window
+    covering its bounds is read.
+    """
 
-    night_raster = rioxarray.open_rasterio(
-        night_path,
-        masked=True,
-        chunks={'x': 1000, 'y': 1000}
-    )
-    day_raster = rioxarray.open_rasterio(
-        day_path,
-        masked=True,
-        chunks={'x': 1000, 'y': 1000}
-    )
+    night_raster = open_landscan_window(night_path, clip=clip, chunk_size=chunk_size)
+    day_raster = open_landscan_window(day_path, clip=clip, chunk_size=chunk_size)
 
     return night_raster, day_raster
 
 
+def open_landscan_window(path, clip=None, chunk_size=1000):
+
+    with rasterio.open(path) as src:
+        block_y, block_x = src.block_shapes[0]
+        height, width = src.height, src.width
+        transform = src.transform
+        crs = src.crs
+
+    chunks = {
+        'x': block_x * max(1, chunk_size // block_x),
+        'y': block_y * max(1, chunk_size // block_y)
+    }
+    raster = rioxarray.open_rasterio(path, masked=True, chunks=chunks)
+
+    if clip is None:
+        return raster
+
+    # expand the window out to block boundaries so every chunk read is whole blocks
+    window = windows.from_bounds(*clip_bounds(clip, crs), transform=transform)
+    row_start = max(0, int(math.floor(window.row_off / block_y)) * block_y)
+    col_start = max(0, int(math.floor(window.col_off / block_x)) * block_x)
+    row_stop = min(height, int(math.ceil((window.row_off + window.height) / block_y)) * block_y)
+    col_stop = min(width, int(math.ceil((window.col_off + window.width) / block_x)) * block_x)
+    if row_stop <= row_start or col_stop <= col_start:
+        raise ValueError('Clip bounds do not intersect raster {}'.format(path))
+
+    return raster.isel(y=slice(row_start, row_stop), x=slice(col_start, col_stop))
+
+
+def clip_bounds(clip, crs=None):
+    """
+    (minx, miny, maxx, maxy) of a GeoDataFrame/GeoSeries (reprojected to crs), shapely geometry or bounds tuple
+    """
+
+    if hasattr(clip, 'total_bounds'):
+        if crs is not None and clip.crs is not None and clip.crs != crs:
+            clip = clip.to_crs(crs)
+        return tuple(clip.total_bounds)
+    if hasattr(clip, 'bounds'):
+        return tuple(clip.bounds)
+
+    return tuple(clip)
+
+
+def combine_mean(night, day, out, day_weight=None):
+    """
+    Mean of the floored layers, rounded half to even like numpy.round, in integer arithmetic
+    """
+
+    np.add(night, day, out=night)
+    np.right_shift(night, 1, out=out, casting='unsafe')
+    # add one where the sum is odd and the halved value is odd (x.5 rounds to the even neighbour)
+    np.bitwise_and(night, 1, out=day)
+    np.bitwise_and(day, out, out=day)
+    np.add(out, day, out=out, casting='unsafe')
+
+
+def combine_max(night, day, out, day_weight=None):
+    np.maximum(night, day, out=out, casting='unsafe')
+
+
+def combine_weighted(night, day, out, day_weight=0.5):
+    """
+    (1 - day_weight) * night + day_weight * day, rounded half to even
+    """
+
+    blend = night * (1 - day_weight)
+    blend += day * day_weight
+    np.round(blend, out=blend)
+    out[...] = blend
+
+
+# rules combining the floored night and day layers of a strip of rows into the output strip
+COMBINE_RULES = {
+    'mean': combine_mean,
+    'max': combine_max,
+    'weighted': combine_weighted,
+}
+
+# rows of a block floored and combined at a time, bounding the int64 temporaries to a strip of the output
+COMBINE_STRIP_ROWS = 512
+
+
+def average_population_block(night, day, rule='mean', dtype='int32', day_weight=0.5):
+    """
+    Floor both layers to whole persons (nodata as 0) and combine them with a COMBINE_RULES rule, writing strip by
+    strip straight into one integer output block. Blocks with no data in either layer are returned as zeros without
+    further work.
+    """
+
+    try:
+        combine_fxn = COMBINE_RULES[rule]
+    except KeyError:
+        raise ValueError(f'Unknown combine rule {rule}; expected one of {list(COMBINE_RULES)}.')
+
+    if np.isnan(night).all() and np.isnan(day).all():
+        return np.zeros(night.shape, dtype=dtype)
+
+    out = np.empty(night.shape, dtype=dtype)
+    out_rows = out.reshape(-1, out.shape[-1]) if out.ndim > 1 else out.reshape(1, -1)
+    night_rows = night.reshape(out_rows.shape)
+    day_rows = day.reshape(out_rows.shape)
+
+    for start in range(0, out_rows.shape[0], COMBINE_STRIP_ROWS):
+        rows = slice(start, start + COMBINE_STRIP_ROWS)
+        night_int = np.nan_to_num(np.floor(night_rows[rows]), nan=0).astype('int64')
+        day_int = np.nan_to_num(np.floor(day_rows[rows]), nan=0).astype('int64')
+        combine_fxn(night_int, day_int, out_rows[rows], day_weight=day_weight)
+
+    return out
+
+
 class Landscan:
 
     def __init__(self, night_raster, day_raster, shp):
@@ -64,37 +186,53 @@ class Landscan:
         self.average_raster = None
         self.average_raster_dask = None
         self.spdf = None
+        self.zones = None
 
-    def average_population(self):
+    def average_population(self, rule='mean', dtype='int32', day_weight=0.5):
         """
         Calculate the average population from night and day population rasters
+        rule: COMBINE_RULES key; 'mean' (default), 'max' or 'weighted' (day layer weighted by day_weight)
+        dtype: integer dtype of the population layers
         """
 
         assert self.night_raster.rio.crs == self.day_raster.rio.crs
         self.raster_crs = self.night_raster.rio.crs
 
         # convert floats to integers
-        night_int = floor_integer(self.night_raster)
-        day_int = floor_integer(self.day_raster)
-
-        # convert data arrays to datasets
-        night_ds = night_int.to_dataset(name='night_population')
-        day_ds = day_int.to_dataset(name='day_population')
-
-        # merge datasets
-        average_raster = xr.merge([night_ds, day_ds])
-
-        # calculate average and round to lowest whole person
-        avg_pop = average_raster.to_array(dim='new').mean('new')
-        avg_pop_round = avg_pop.round()
-        avg_pop_int = floor_integer(avg_pop_round)
+        night_int = floor_integer(self.night_raster, dtype=dtype)
+        day_int = floor_integer(self.day_raster, dtype=dtype)
+
+        # floor and combine chunk by chunk, skipping blocks that are all nodata; this only builds the dask graph, so
+        # the combine is measured in the stages that compute average_raster (zone_join, dask_spatial_sort, ...)
+        avg_pop_int = xr.apply_ufunc(
+            average_population_block, self.night_raster, self.day_raster,
+            kwargs={'rule': rule, 'dtype': dtype, 'day_weight': day_weight},
+            dask='parallelized', output_dtypes=[dtype]
+        )
 
-        # add average population dimension to dataset
+        average_raster = xr.merge([
+            night_int.to_dataset(name='night_population'),
+            day_int.to_dataset(name='day_population')
+        ])
         self.average_raster = average_raster.assign(average_population=avg_pop_int)
 
-    def dask_spatial_sort(self, savepath):
+    def dask_spatial_sort(self, savepath=None, cache=None):
+        """
+        Hilbert sort the averaged raster cells into spatially partitioned parquet at savepath. With a
+        SortedParquetCache, a dataset previously sorted from the same rasters, chunking and partition count is
+        reused from the cache instead of recomputed (savepath is then not needed).
+        """
 
         ddf = self.average_raster.to_dask_dataframe()
+
+        if cache is not None:
+            key = cache.key(self.average_raster, ddf.npartitions)
+            cached_path = cache.lookup(key)
+            if cached_path is not None:
+                self.average_raster_dask = spd.io.read_parquet_dask(cached_path)
+                return
+            savepath = cache.entry_path(key)
+
         df = ddf.map_partitions(
             lambda df: spd.GeoDataFrame(dict(
                 position=PointArray(df[['x', 'y']]),
@@ -104,7 +242,13 @@ class Landscan:
 
         # todo: do we have to save this to disk and reload to get the benefits of dask parallelization?
         t0 = time.time()
-        df.pack_partitions(npartitions=df.npartitions, shuffle='disk').to_parquet(savepath)
+        sort_and_save = lambda path: df.pack_partitions(npartitions=df.npartitions, shuffle='disk').to_parquet(path)
+        with instrumentation.stage('landscan.dask_spatial_sort', cells=self.average_raster['average_population'].size,
+                                   partitions=df.npartitions):
+            if cache is not None:
+                cache.store(key, sort_and_save)
+            else:
+                sort_and_save(savepath)
         dt = time.time() - t0
         logging.info(f'Spatial sort required {dt} seconds.')
 
@@ -117,10 +261,10 @@ class Landscan:
 
         load_gpd = self.shp[['GEOID', 'geometry']]
         try:
-            load_gpd.to_crs(self.raster_crs)
+            load_gpd = load_gpd.to_crs(self.raster_crs)
         except Exception:
-            logging.debug(f'Unable to convert shapefile {self.shp_path} to CRS {self.raster_crs}')
-            raise Exception
+            logging.debug(f'Unable to convert shapefile to CRS {self.raster_crs}')
+            raise
 
         self.shp_crs = load_gpd.crs
         self.spdf = spd.geodataframe.GeoDataFrame(load_gpd, geometry='geometry')
@@ -129,7 +273,142 @@ class Landscan:
     def spd_sjoin_wrapper(self):
 
         assert self.raster_crs == self.shp_crs
-        rdf = spd.sjoin(self.average_raster_dask, self.spdf, how='inner').compute()
+        with instrumentation.stage('landscan.sjoin', zones=len(self.spdf)) as record:
+            rdf = spd.sjoin(self.average_raster_dask, self.spdf, how='inner').compute()
+            record['rows'] = len(rdf)
+
+    def zone_index(self, cache_path=None):
+        """
+        Burn the tract polygons onto the LandScan grid as an integer zone raster (see rasterize_zones), reusing
+        the copy cached at cache_path when it was built from the same tracts and grid. The zone raster only
+        depends on the grid, so one cached copy serves every year and the night, day and average layers.
+        """
+
+        with instrumentation.stage('landscan.zone_index', zones=len(self.shp), cells=self.night_raster.size):
+            self.zones = cached_zone_raster(self.shp, self.night_raster, cache_path)
+
+    def zone_join(self, layers=('night_population', 'day_population', 'average_population')):
+        """
+        Assign every cell inside a tract to its GEOID by array lookup against the zone raster; replaces the
+        point-in-polygon sjoin. Returns one row per cell within a tract, like an inner sjoin.
+        """
+
+        if self.zones is None:
+            self.zone_index()
+
+        codes = self.zones['zone_code'].values
+        with instrumentation.stage('landscan.zone_join', cells=codes.size, layers=list(layers)) as record:
+            # index the in-zone cells directly instead of building full x/y grids
+            rows, cols = np.nonzero(codes >= 0)
+            joined = pd.DataFrame({'x': self.zones['x'].values[cols], 'y': self.zones['y'].values[rows]})
+            joined['GEOID'] = pd.Categorical.from_codes(codes[rows, cols], categories=self.zones['zone_id'].values)
+
+            for layer in layers:
+                values = self.average_raster[layer].squeeze(drop=True).transpose('y', 'x').values
+                joined[layer] = values[rows, cols]
+            record['rows'] = len(joined)
+
+        return joined
+
+
+class SortedParquetCache:
+    """
+    Content-addressed cache of spatially sorted parquet datasets on a scratch filesystem. Entries are keyed by a
+    hash of the inputs and evicted least recently used first once the cache grows beyond max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, raster, npartitions):
+        """
+        Hash of the input raster (dask token: source files plus every operation applied, or the data itself for
+        in-memory rasters), its chunking and the partition count
+        """
+
+        return dask.base.tokenize(raster, dict(raster.chunksizes), npartitions)
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.parquet')
+
+    def lookup(self, key):
+        """
+        Path of the cached dataset for key, or None on a miss; hits refresh the entry for eviction purposes
+        """
+
+        path = self.entry_path(key)
+        if os.path.exists(path):
+            self.hits += 1
+            os.utime(path)
+            logging.info(f'Sorted parquet cache hit for {key} ({self.hits} hits, {self.misses} misses)')
+            return path
+
+        self.misses += 1
+        logging.info(f'Sorted parquet cache miss for {key} ({self.hits} hits, {self.misses} misses)')
+        return None
+
+    def store(self, key, write_fxn):
+        """
+        Write an entry with write_fxn(path) into a temporary location and move it into place, so an interrupted
+        write is never mistaken for a cached dataset; then evict down to the size bound. If another job stored the
+        same key first, its entry is kept and returned.
+        """
+
+        path = self.entry_path(key)
+        tmp_path = tempfile.mkdtemp(prefix=f'.{key}.', dir=self.cache_dir)
+        try:
+            write_fxn(tmp_path)
+            # mkdtemp creates the directory 0700; let other users of the scratch filesystem read the entry
+            os.chmod(tmp_path, 0o755)
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.exists(path):
+                raise
+            logging.info(f'Sorted parquet cache entry {key} was stored by another job; using it')
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        self.evict(keep=path)
+
+        return path
+
+    def entry_size(self, path):
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits in max_bytes; the entry at keep is never removed
+        """
+
+        if self.max_bytes is None:
+            return
+
+        entries = [
+            os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+            if name.endswith('.parquet') and not name.startswith('.')
+        ]
+        sizes = {path: self.entry_size(path) for path in entries}
+        total = sum(sizes.values())
+
+        for path in sorted(entries, key=os.path.getmtime):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            total -= sizes[path]
+            logging.info(f'Evicted {path} from sorted parquet cache')
 
 
 # wrapper function moified from https://towardsdatascience.com/geospatial-operations-at-scale-with-dask-and-geopandas-4d92d00eb7e8
@@ -155,11 +434,158 @@ def sjoin_wrapper(dask_df, geo_df):
 #  object_encoding='json', compression="SNAPPY")
 
 
+class ZoneJoiner:
+    """
+    Point-in-polygon join engine for raw x/y arrays. The STRtree and polygon bounds are built once, and the
+    joiner is shipped to each dask worker a single time (see map_partitions). Cells are assigned compact int32
+    zone codes (-1 outside every polygon) that index into zone_ids, without creating Point objects.
+    shp: geopandas.GeoDataFrame of zones (tracts, counties, ZCTAs, ...) with id_column and geometry columns
+    crs: CRS of the x/y coordinates; the zones are reprojected to it if given
+    """
+
+    def __init__(self, shp, id_column='GEOID', crs=None):
+        zones = shp[[id_column, 'geometry']]
+        if crs is not None:
+            zones = zones.to_crs(crs)
+        zones = zones[zones.geometry.notna() & ~zones.geometry.is_empty]
+
+        self.geometry_codes, zone_ids = pd.factorize(zones[id_column].astype(str))
+        self.geometry_codes = self.geometry_codes.astype('int32')
+        self.zone_ids = np.asarray(zone_ids, dtype=str)
+        self.geometries = np.asarray(zones.geometry.values, dtype=object)
+        self.bounds = shapely.bounds(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+    def zone_codes(self, x, y):
+        """
+        Zone code of the polygon containing each (x, y) point
+        """
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        codes = np.full(len(x), -1, dtype='int32')
+        if len(x) == 0:
+            return codes
+
+        # preparing is a no-op after the first partition a worker sees
+        shapely.prepare(self.geometries)
+
+        # sort by x once so each candidate polygon scans only the points inside its x extent
+        order = np.argsort(x, kind='stable')
+        x_sorted = x[order]
+        y_sorted = y[order]
+
+        extent = shapely.box(x_sorted[0], np.nanmin(y), x_sorted[-1], np.nanmax(y))
+        for geometry in self.tree.query(extent):
+            xmin, ymin, xmax, ymax = self.bounds[geometry]
+            start = np.searchsorted(x_sorted, xmin, side='left')
+            stop = np.searchsorted(x_sorted, xmax, side='right')
+            in_box = start + np.flatnonzero((y_sorted[start:stop] >= ymin) & (y_sorted[start:stop] <= ymax))
+            inside = shapely.contains_xy(self.geometries[geometry], x_sorted[in_box], y_sorted[in_box])
+            codes[order[in_box[inside]]] = self.geometry_codes[geometry]
+
+        return codes
+
+    def geoids(self, codes):
+        """
+        Decode zone codes to a categorical of zone ids (missing outside every zone)
+        """
+
+        return pd.Categorical.from_codes(codes, categories=self.zone_ids)
+
+    def map_partitions(self, dask_df, x='x', y='y'):
+        """
+        Zone codes for every row of a dask DataFrame; the joiner enters the graph once as a shared input
+        instead of being rebuilt or serialized for every partition
+        """
+
+        shipped = dask.delayed(self, pure=True)
+        return dask_df.map_partitions(zone_codes_partition, shipped, x, y, meta=('zone_code', 'int32'))
+
+
+def zone_codes_partition(df, joiner, x='x', y='y'):
+
+    return pd.Series(joiner.zone_codes(df[x].values, df[y].values), index=df.index, name='zone_code')
+
+
+def rasterize_zones(shp, raster_xr, id_column='GEOID'):
+    """
+    Burn polygons onto the grid of raster_xr, producing an int32 code raster aligned to the raster transform.
+    A cell gets the code of the polygon containing its center (-1 outside every polygon), which matches a
+    points-within spatial join of the cell centers. Codes index into the unique 'zone_id' lookup coordinate, so
+    multipart or exploded zones sharing an id get the same code.
+    shp: geopandas.GeoDataFrame with id_column and geometry columns
+    raster_xr: rioxarray raster defining the grid
+    """
+
+    zones = shp[[id_column, 'geometry']].to_crs(raster_xr.rio.crs)
+    zones = zones[zones.geometry.notna() & ~zones.geometry.is_empty]
+
+    zone_codes, zone_ids = pd.factorize(zones[id_column].astype(str))
+    codes = features.rasterize(
+        zip(zones.geometry.values, zone_codes.tolist()),
+        out_shape=(raster_xr.rio.height, raster_xr.rio.width),
+        transform=raster_xr.rio.transform(),
+        fill=-1,
+        dtype='int32'
+    )
+
+    zone_xr = xr.Dataset(
+        data_vars=dict(zone_code=(['y', 'x'], codes)),
+        coords=dict(
+            y=(['y', ], raster_xr['y'].values),
+            x=(['x', ], raster_xr['x'].values),
+            zone_id=(['zone', ], np.asarray(zone_ids, dtype=str))
+        ),
+        attrs=dict(fingerprint=zone_fingerprint(shp, raster_xr, id_column))
+    )
+
+    return zone_xr
+
+
+def zone_fingerprint(shp, raster_xr, id_column='GEOID'):
+    """
+    Hash of the zone ids, zone geometries and raster grid, used to decide whether a cached zone raster is reusable
+    """
+
+    fingerprint = hashlib.sha1()
+    fingerprint.update(str(raster_xr.rio.crs).encode())
+    fingerprint.update(str(tuple(raster_xr.rio.transform())).encode())
+    fingerprint.update(str((raster_xr.rio.height, raster_xr.rio.width)).encode())
+    fingerprint.update('|'.join(shp[id_column].astype(str)).encode())
+    for wkb in shp.geometry.to_wkb():
+        fingerprint.update(wkb if wkb is not None else b'')
+
+    return fingerprint.hexdigest()
+
+
+def cached_zone_raster(shp, raster_xr, cache_path=None, id_column='GEOID'):
+    """
+    Load the zone raster from cache_path if it matches the zones and grid, otherwise rasterize and cache it
+    """
+
+    if cache_path is not None and os.path.exists(cache_path):
+        with xr.open_dataset(cache_path) as cached:
+            zone_xr = cached.load()
+        if zone_xr.attrs.get('fingerprint') == zone_fingerprint(shp, raster_xr, id_column):
+            logging.info(f'Using cached zone raster {cache_path}')
+            return zone_xr
+        logging.info(f'Cached zone raster {cache_path} does not match the zones or grid; rebuilding')
+
+    zone_xr = rasterize_zones(shp, raster_xr, id_column)
+    if cache_path is not None:
+        zone_xr.to_netcdf(cache_path)
+
+    return zone_xr
+
+
 def make_divisible_square_extent(raster_xr, finalize_fxn, multiple=None):
     """
     pad raster with zeros to expand extent
     raster_xr: raster data in xarray
     multiple: None or integer value by which raster extent should be divisible
+    dask-backed rasters stay lazy; their chunks are widened to a multiple of `multiple` so that aggregation
+    windows never straddle chunk boundaries
     """
 
     n_row = raster_xr.rio.height
@@ -170,18 +596,25 @@ def make_divisible_square_extent(raster_xr, finalize_fxn, multiple=None):
     # ensure the new dimensions are divisible by the desired aggregation scale
     if multiple:
         new_dim = math.ceil(new_dim / multiple) * multiple
+        if raster_xr.chunks is not None:
+            raster_xr = raster_xr.chunk({
+                dim: math.ceil(raster_xr.chunksizes[dim][0] / multiple) * multiple for dim in ['x', 'y']
+            })
 
     # extend the x and y coordinates at the appropriate resolutions
     y_resolution = raster_xr.rio.resolution()[1]
     x_resolution = raster_xr.rio.resolution()[0]
 
-    start_x = raster_xr['x'][-1]
-    start_y = raster_xr['y'][-1]
+    start_x = raster_xr['x'].values[-1]
+    start_y = raster_xr['y'].values[-1]
 
     # set the diagonal
-    new_x = np.array([start_x + i * x_resolution for i in range(1, new_dim - n_col + 1)])
-    new_y = np.array([start_y + i * y_resolution for i in range(1, new_dim - n_row + 1)])
-    population = np.zeros((len(new_x), len(new_y))).astype(int)
+    new_x = start_x + x_resolution * np.arange(1, new_dim - n_col + 1)
+    new_y = start_y + y_resolution * np.arange(1, new_dim - n_row + 1)
+    if raster_xr.chunks is not None:
+        population = da.zeros((len(new_x), len(new_y)), dtype=int, chunks=raster_xr.chunksizes['x'][0])
+    else:
+        population = np.zeros((len(new_x), len(new_y)), dtype=int)
 
     final_xr = finalize_fxn(new_x, new_y, population, raster_xr)
 
@@ -189,6 +622,12 @@ def make_divisible_square_extent(raster_xr, finalize_fxn, multiple=None):
 
 
 def merge_datasets(new_x, new_y, population, original_array):
+    """
+    Concatenate the zero padding onto the original raster, filling the gaps with zeros. Stays lazy for dask-backed
+    rasters: the padded array keeps the original chunking and the population totals used by the conservation check
+    are attached as lazy scalar coordinates, computed alongside whatever downstream step first loads the data.
+    """
+
     extended_xr = xr.Dataset(
         data_vars=dict(population=(['x', 'y'], population)),
         coords=dict(
@@ -199,7 +638,8 @@ def merge_datasets(new_x, new_y, population, original_array):
 
     final_xr = xr.combine_nested(
         [[original_array.to_dataset(name='population')], [extended_xr]],
-        concat_dim=['x', 'y']
+        concat_dim=['x', 'y'],
+        join='outer'
     )
 
     # fill NaN with 0 and recast type to int
@@ -207,16 +647,38 @@ def merge_datasets(new_x, new_y, population, original_array):
     final_xr_array = final_xr_array.fillna(0)
     final_xr_array = final_xr_array.astype('int')
 
-    # confirm no data loss (or gain) in concatenation
+    if final_xr_array.chunks is not None:
+        final_xr_array = final_xr_array.chunk({dim: original_array.chunksizes[dim][0] for dim in ['x', 'y']})
+
+    # record totals for the no data loss (or gain) check as reductions over the same graph
+    original_total = original_array.sum(skipna=True).data + extended_xr['population'].sum().data
+    final_xr_array = final_xr_array.assign_coords(
+        original_total=((), original_total),
+        padded_total=((), final_xr_array.sum().data)
+    )
+
+    if final_xr_array.chunks is None:
+        check_population_conservation(final_xr_array)
+
+    return final_xr_array
+
+
+def check_population_conservation(xr_array):
+    """
+    Confirm that padding neither lost nor gained population, using the totals recorded by merge_datasets.
+    Any still-lazy totals are computed here, so call it after the downstream computation when possible.
+    """
+
+    total_a = xr_array['original_total'].values.item()
+    total_b = xr_array['padded_total'].values.item()
     try:
-        total_a = np.nansum(original_array.values.flatten()) + np.nansum(extended_xr['population'].values.flatten())
-        total_b = np.nansum(final_xr_array.values.flatten())
         print(f'Aggregate total = {total_a}; final total = {total_b}')
         assert total_a == total_b
     except AssertionError:
         print(f'Aggregate total {total_a} is not equal to final total {total_b}')
+        return False
 
-    return final_xr_array
+    return True
 
 
 def non_overlapping_tiles(total_length, tile_length):
@@ -226,14 +688,100 @@ def non_overlapping_tiles(total_length, tile_length):
     return slices
 
 
+# reducers applied over the window axes of a blocked array; NaN cells are ignored, matching the nansum checks above
+BLOCK_REDUCERS = {
+    'sum': lambda blocks, axis: np.nansum(blocks, axis=axis),
+    'mean': lambda blocks, axis: np.nanmean(blocks, axis=axis),
+    'count': lambda blocks, axis: (~np.isnan(blocks)).sum(axis=axis),
+}
+
+
+def block_reduce_array(values, window_size, axes, reducer='sum'):
+    """
+    Aggregate non-overlapping square windows of a numpy or dask array with one reshape and one reduction.
+    values: array whose sizes along `axes` are divisible by window_size
+    window_size: number of cells along each edge of the aggregation window
+    axes: the two axes (e.g. the x and y axes) to aggregate over
+    reducer: one of 'sum', 'mean' or 'count'
+    """
+
+    try:
+        reduce_fxn = BLOCK_REDUCERS[reducer]
+    except KeyError:
+        raise ValueError(f'Unknown reducer {reducer}; expected one of {list(BLOCK_REDUCERS)}.')
+
+    axes = [a % values.ndim for a in axes]
+
+    # split each aggregated axis into (block, position within block) and reduce over the positions
+    blocked_shape = []
+    window_axes = []
+    for axis, size in enumerate(values.shape):
+        if axis in axes:
+            if size % window_size != 0:
+                raise ValueError(f'Axis {axis} of length {size} is not divisible by window size {window_size}.')
+            blocked_shape.extend([size // window_size, window_size])
+            window_axes.append(len(blocked_shape) - 1)
+        else:
+            blocked_shape.append(size)
+
+    blocks = values.reshape(blocked_shape)
+
+    return reduce_fxn(blocks, axis=tuple(window_axes))
+
+
+def block_reduce(raster_xr, window_size, reducer='sum'):
+    """
+    Reduce the resolution of a gridded xarray.DataArray by aggregating non-overlapping window_size x window_size
+    blocks of cells. Coordinates of the reduced grid are the block centers (the mean of the original coordinates).
+    Works on numpy- and dask-backed arrays; dask arrays stay lazy.
+    raster_xr: xarray.DataArray with 'x' and 'y' dimensions
+    window_size: number of cells along each edge of the aggregation window
+    reducer: one of 'sum', 'mean' or 'count'
+    """
+
+    axes = (raster_xr.get_axis_num('x'), raster_xr.get_axis_num('y'))
+    reduced = block_reduce_array(raster_xr.data, window_size, axes=axes, reducer=reducer)
+
+    return reduced_grid(raster_xr, reduced, window_size)
+
+
+def reduced_grid(raster_xr, reduced, window_size):
+    """
+    Wrap an array of block-reduced values in an xarray.DataArray carrying the block-center coordinates of raster_xr
+    raster_xr: the full resolution xarray.DataArray the values were reduced from
+    reduced: numpy or dask array produced by block_reduce_array over the x and y axes of raster_xr
+    window_size: number of cells along each edge of the aggregation window
+    """
+
+    coords = {
+        name: coord for name, coord in raster_xr.coords.items()
+        if 'x' not in coord.dims and 'y' not in coord.dims
+    }
+    for dim in ['x', 'y']:
+        coords[dim] = raster_xr[dim].values.reshape(-1, window_size).mean(axis=1)
+
+    reduced_xr = xr.DataArray(
+        reduced,
+        dims=raster_xr.dims,
+        coords=coords,
+        name=raster_xr.name,
+        attrs=raster_xr.attrs
+    )
+
+    if raster_xr.rio.crs is not None:
+        reduced_xr = reduced_xr.rio.write_crs(raster_xr.rio.crs)
+
+    return reduced_xr
+
+
 class ReduceRaster:
 
-    def __init__(self, square_raster, window_size, chunk_size):
+    def __init__(self, square_raster, window_size, chunk_size, reducer='sum'):
 
         self.square_raster = square_raster
         self.window_size = window_size
         self.chunk_size = chunk_size
-        self.tile_indexes = None
+        self.reducer = reducer
 
     def sanity_checks(self):
 
@@ -271,85 +819,256 @@ class ReduceRaster:
         return n_errors
 
     def agg_tile(self, raster_chunk):
+        """
+        Aggregate one chunk of the raster to the reduced resolution grid
+        """
+
+        return block_reduce(raster_chunk, window_size=self.window_size, reducer=self.reducer)
+
+    def chunk_indexes(self):
+        """
+        Index tuples selecting each non-overlapping chunk_size x chunk_size chunk of the raster values
+        """
+
+        xr_slices = non_overlapping_tiles(total_length=self.square_raster.rio.height, tile_length=self.chunk_size)
+        x_axis = self.square_raster.get_axis_num('x')
+        y_axis = self.square_raster.get_axis_num('y')
+
+        indexes = []
+        for i in range(1, len(xr_slices)):
+            for j in range(1, len(xr_slices)):
+                index = [slice(None)] * self.square_raster.ndim
+                index[x_axis] = slice(xr_slices[i - 1], xr_slices[i])
+                index[y_axis] = slice(xr_slices[j - 1], xr_slices[j])
+                indexes.append(tuple(index))
 
-        agg_data = dict(x=list(), y=list(), population=list())
+        return indexes
 
-        for i in range(1, len(self.tile_indexes)):
-            for j in range(1, len(self.tile_indexes)):
-                to_aggregate = raster_chunk.isel(
-                    x=np.arange(self.tile_indexes[i - 1], self.tile_indexes[i]),
-                    y=np.arange(self.tile_indexes[j - 1], self.tile_indexes[j])
-                )
-                agg_data['x'].append(np.mean(to_aggregate['x']).values.item())
-                agg_data['y'].append(np.mean(to_aggregate['y']).values.item())
-                agg_data['population'].append(sum(to_aggregate.values.flatten()))
+    def assemble_chunks(self, indexes, reduced_chunks):
+        """
+        Write reduced chunks into a single preallocated array as they arrive from the workers
+        """
 
-        agg_df = pd.DataFrame.from_dict(agg_data)
+        axes = (self.square_raster.get_axis_num('x'), self.square_raster.get_axis_num('y'))
+        reduced_shape = [
+            size // self.window_size if axis in axes else size for axis, size in enumerate(self.square_raster.shape)
+        ]
+
+        reduced = None
+        for index, chunk in zip(indexes, reduced_chunks):
+            if reduced is None:
+                reduced = np.empty(reduced_shape, dtype=chunk.dtype)
+            reduced_index = tuple(
+                slice(s.start // self.window_size, s.stop // self.window_size) if axis in axes else s
+                for axis, s in enumerate(index)
+            )
+            reduced[reduced_index] = chunk
 
-        return agg_df
+        return reduced
 
-    def reduce_raster_resolution(self, ncpu):
+    def reduce_raster_resolution(self, ncpu, backend='process', scratch_dir=None):
+        """
+        Reduce the raster resolution chunk by chunk in parallel, returning the reduced grid as an xarray.DataArray.
+        ncpu: number of workers
+        backend: 'process' (worker processes reading chunks from one shared copy of the raster), 'thread' (threads
+            reading chunks from the in-memory raster) or 'dask' (lazy block reduction computed by the dask scheduler)
+        scratch_dir: for the process backend, share the raster through a memory-mapped file in this directory
+            instead of a shared memory segment (useful when /dev/shm is small)
+        """
 
         n_errors = self.sanity_checks()
         if n_errors > 0:
             raise AssertionError('Incorrect parameterization for resolution reduction.')
 
-        # set standard coordinate slices to use for processing data within chunks
-        self.tile_indexes = non_overlapping_tiles(total_length=self.chunk_size, tile_length=self.window_size)
+        with instrumentation.stage('reduce_raster.reduce_raster_resolution', backend=backend, ncpu=ncpu,
+                                   cells=self.square_raster.size, window_size=self.window_size):
+            if backend == 'process':
+                reduced, totals = self.reduce_with_processes(ncpu, scratch_dir)
+            elif backend == 'thread':
+                reduced, totals = self.reduce_with_threads(ncpu)
+            elif backend == 'dask':
+                # the padding totals are lazy coordinates, so they are computed in the same graph as the reduction
+                chunked = self.square_raster.chunk({'x': self.chunk_size, 'y': self.chunk_size})
+                reduced_xr = block_reduce(chunked, self.window_size, reducer=self.reducer).compute(num_workers=ncpu)
+            else:
+                raise ValueError(f'Unknown backend {backend}; expected one of process, thread or dask.')
+
+        if backend != 'dask':
+            reduced_xr = reduced_grid(self.square_raster, reduced, self.window_size)
+            reduced_xr = reduced_xr.assign_coords({name: ((), total) for name, total in totals.items()})
+
+        if 'original_total' in reduced_xr.coords:
+            check_population_conservation(reduced_xr)
+
+        return reduced_xr
+
+    def padding_totals(self):
+        """
+        Population totals recorded by merge_datasets, still lazy if the square raster is dask-backed
+        """
+
+        return {
+            name: self.square_raster[name].data for name in ['original_total', 'padded_total']
+            if name in self.square_raster.coords
+        }
 
-        # slice the xarray into large chunks for parallel processing
-        xr_slices = non_overlapping_tiles(total_length=self.square_raster.rio.height, tile_length=self.chunk_size)
+    def reduce_with_threads(self, ncpu):
 
-        tasks = []
-        for i in range(1, len(xr_slices)):
-            for j in range(1, len(xr_slices)):
-                tasks.append(self.square_raster.isel(
-                    x=np.arange(xr_slices[i - 1], xr_slices[i]),
-                    y=np.arange(xr_slices[j - 1], xr_slices[j])
-                ))
+        # numpy releases the GIL inside the reductions, so threads can share the raster without copying it
+        values, totals = dask.compute(self.square_raster.data, self.padding_totals())
+        values = np.asarray(values)
+        axes = (self.square_raster.get_axis_num('x'), self.square_raster.get_axis_num('y'))
+        reduce_chunk = partial(block_reduce_array, window_size=self.window_size, axes=axes, reducer=self.reducer)
+
+        indexes = self.chunk_indexes()
+        with ThreadPoolExecutor(ncpu) as executor:
+            reduced_chunks = executor.map(lambda index: reduce_chunk(values[index]), indexes)
+            reduced = self.assemble_chunks(indexes, reduced_chunks)
+
+        return reduced, totals
+
+    def reduce_with_processes(self, ncpu, scratch_dir=None):
+
+        shape = self.square_raster.shape
+        dtype = self.square_raster.dtype
+        shm = None
+        memmap_path = None
+
+        # write the raster once into a buffer every worker can map, streaming dask chunks so the raster is
+        # materialized only in the shared buffer
+        if scratch_dir is None:
+            shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+            shared_values = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        else:
+            fd, memmap_path = tempfile.mkstemp(suffix='.raster', dir=scratch_dir)
+            os.close(fd)
+            shared_values = np.memmap(memmap_path, dtype=dtype, mode='w+', shape=shape)
+
+        try:
+            totals = self.padding_totals()
+            if isinstance(self.square_raster.data, da.Array):
+                store = da.store(self.square_raster.data, shared_values, lock=False, compute=False)
+                _, totals = dask.compute(store, totals)
+            else:
+                shared_values[...] = self.square_raster.data
+            if memmap_path is not None:
+                shared_values.flush()
+
+            axes = (self.square_raster.get_axis_num('x'), self.square_raster.get_axis_num('y'))
+            reduce_chunk = partial(
+                reduce_shared_chunk, window_size=self.window_size, axes=axes, reducer=self.reducer)
+            initargs = (shm.name if shm is not None else None, shape, dtype.str, memmap_path)
+
+            # tasks carry only chunk indexes; workers attach to the shared raster once in the initializer
+            indexes = self.chunk_indexes()
+            with mp.Pool(ncpu, initializer=attach_shared_raster, initargs=initargs) as pool:
+                reduced = self.assemble_chunks(indexes, pool.imap(reduce_chunk, indexes))
+        finally:
+            del shared_values
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            if memmap_path is not None:
+                os.remove(memmap_path)
+
+        return reduced, totals
+
+
+# raster values shared with ReduceRaster worker processes, set once per worker by attach_shared_raster
+_shared_raster = {}
+
+
+def attach_shared_raster(shm_name, shape, dtype, memmap_path):
+    """
+    Pool initializer mapping the shared raster buffer (shared memory segment or memory-mapped file) into a worker
+    """
 
-        pool = mp.Pool(ncpu)
-        results = [pool.apply_async(self.agg_tile, (t,)) for t in tasks]
-        pool.close()
-        outputs = []
-        for r in results:
-            out = r.get()
-            outputs.append(out)
+    if memmap_path is not None:
+        _shared_raster['values'] = np.memmap(memmap_path, dtype=dtype, mode='r', shape=shape)
+    else:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shared_raster['shm'] = shm
+        _shared_raster['values'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
 
-        agg_df = pd.concat(outputs)
 
-        return agg_df
+def reduce_shared_chunk(index, window_size, axes, reducer):
+    """
+    Block-reduce one chunk of the shared raster; the chunk is a view, so nothing is copied into the worker
+    """
+
+    return block_reduce_array(_shared_raster['values'][index], window_size, axes=axes, reducer=reducer)
+
 
+# x coordinates per part file when streaming a fishnet from an in-memory raster
+FISHNET_CHUNK_COLUMNS = 256
 
 
-def fishnet(rio_xarray):
+def fishnet(rio_xarray, drop_zero=False, parquet_path=None, chunk_columns=None):
+    """
+    Build a polygon grid with one box per raster cell, carrying the cell center coordinates and population.
+    rio_xarray: single band raster with x and y dimensions
+    drop_zero: drop cells with zero or missing population
+    parquet_path: None, or a directory to stream the grid into as GeoParquet part files; the path is returned
+        instead of the GeoDataFrame so the full grid never has to fit in memory
+    chunk_columns: number of x coordinates written per part file when streaming (default: the raster's x chunk
+        size if it is dask-backed, otherwise FISHNET_CHUNK_COLUMNS)
+    """
+
+    raster = rio_xarray.squeeze(drop=True).transpose('x', 'y')
 
     # get the offset from the centroid to calculate bounding boxes
-    width = rio_xarray.rio.resolution()[0] / 2
-    height = rio_xarray.rio.resolution()[1] / 2
-
-    x_vals = []
-    y_vals = []
-    polygons = []
-    population = []
-    for x in rio_xarray['x'].values:
-        for y in rio_xarray['y'].values:
-            x_vals.append(x)
-            y_vals.append(y)
-            population.append(
-                rio_xarray.sel({'x': x, 'y': y}).values.item()
-            )
-            polygons.append(Polygon([(x-width,y-width), (x-width, y+height), (x+width, y+height), (x+width, y-height)]))
+    half_width = abs(rio_xarray.rio.resolution()[0]) / 2
+    half_height = abs(rio_xarray.rio.resolution()[1]) / 2
+    crs = rio_xarray.rio.crs
+
+    with instrumentation.stage('fishnet', cells=raster.size, streamed=parquet_path is not None) as record:
+        if parquet_path is None:
+            grid = fishnet_chunk(raster, half_width, half_height, crs, drop_zero)
+            record['rows'] = len(grid)
+            return grid
+
+        os.makedirs(parquet_path, exist_ok=True)
+        n_col = raster.sizes['x']
+        if chunk_columns is not None:
+            step = chunk_columns
+        elif raster.chunks is not None:
+            step = raster.chunksizes['x'][0]
+        else:
+            step = FISHNET_CHUNK_COLUMNS
+        record['rows'] = 0
+        for part, start in enumerate(range(0, n_col, step)):
+            grid = fishnet_chunk(raster.isel(x=slice(start, start + step)), half_width, half_height, crs, drop_zero)
+            grid.to_parquet(os.path.join(parquet_path, f'part-{part:05d}.parquet'))
+            record['rows'] += len(grid)
+
+    return parquet_path
+
+
+def fishnet_chunk(raster, half_width, half_height, crs, drop_zero=False):
+    """
+    Vectorized fishnet construction for a 2D (x, y) raster: all cell boxes are created in one shapely call
+    """
+
+    x, y = np.meshgrid(raster['x'].values, raster['y'].values, indexing='ij')
+    x = x.ravel()
+    y = y.ravel()
+    population = np.asarray(raster.values).ravel()
+
+    if drop_zero:
+        populated = population > 0
+        x = x[populated]
+        y = y[populated]
+        population = population[populated]
 
     grid = gpd.GeoDataFrame(
         {
-            'x': x_vals,
-            'y': y_vals,
-            'geometry': polygons,
+            'x': x,
+            'y': y,
+            'geometry': shapely.box(x - half_width, y - half_height, x + half_width, y + half_height),
             'population': population
-        }
+        },
+        geometry='geometry',
+        crs=crs
     )
 
-    grid = grid.set_crs(rio_xarray.rio.crs)
-
-    return grid
\ No newline at end of file
+    return grid
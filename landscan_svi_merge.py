@@ -1,37 +1,657 @@
 import pandas as pd
 from spatialpandas.io import read_parquet
 import numpy as np
+import multiprocessing as mp
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os
-import sys
+import shutil
+import socket
+import threading
+import time
+import uuid
 import xarray as xr
-import sqlite3
+from demographics_db import DemographicsDB
+import instrumentation
 
+# zarr (2.x or 3.x) is only needed for ZarrStore, the -z/--zarr_store output
+try:
+    import zarr
+except ImportError:
+    zarr = None
 
-def sanity_check(xr1, xr2, columns):
+
+# column name templates for the landscan-weighted estimates
+CORRECTED_TOTAL = '{}_corrected'
+LANDSCAN_COUNT = '{}_LANDSCAN_COUNT'
+LANDSCAN_PERCENT = '{}_LANDSCAN_PERCENT'
+
+# tract-level dollar variables, averaged (not summed) when coarsened
+DOLLAR_COLUMNS = ['MEDIAN_GROSS_RENT_PCT_HH_INCOME', 'PCI']
+
+# display_data UNITS of the count variables, each normalized by a tract total
+COUNT_UNITS = ['persons commuting', 'persons', 'households', 'housholds', 'housing units', 'housing structures']
+
+# 3 to 30 arcsecond coarsening factor
+COARSEN_FACTOR = 10
+
+# pyramid levels, each coarsened from the one before: 3" base, 30" (~1 km), 1', 5' and 10'
+PYRAMID_FACTORS = [COARSEN_FACTOR, 2, 5, 2]
+
+# per-cell dollar value counts carried through the pyramid so every level averages the base cells
+DOLLAR_COUNT = '{}_count'
+
+
+def sanity_check(xr1, xr2, columns, rtol=None):
+    """
+    Compare column totals across resolutions; rtol switches from an absolute (3 decimal) to a relative comparison,
+    needed when the grid is stored as float32
+    """
 
     for c in columns:
-        np.testing.assert_almost_equal(
-            np.nansum(xr1[c].values.flatten()),
-            np.nansum(xr2[c].values.flatten()),
-            decimal=3
+        total_1 = np.nansum(np.asarray(xr1[c].values, dtype='float64').flatten())
+        total_2 = np.nansum(np.asarray(xr2[c].values, dtype='float64').flatten())
+        if rtol is None:
+            np.testing.assert_almost_equal(total_1, total_2, decimal=3)
+        else:
+            np.testing.assert_allclose(total_1, total_2, rtol=rtol)
+
+
+class CellGrid:
+    """
+    Regular grid of raster cell centers, used to scatter sparse cell rows straight into arrays by integer
+    index instead of unstacking an (x, y) MultiIndex with to_xarray.
+    x0, y0: coordinates of the first cell center along each axis
+    x_res, y_res: cell spacing along each axis (coordinates increase along both axes, as with to_xarray)
+    width, height: number of cells along x and y
+    col0: column of the full grid where this grid starts, for tiles addressed by flat full-grid cell indexes
+    """
+
+    def __init__(self, x0, y0, x_res, y_res, width, height, col0=0):
+        self.x0 = x0
+        self.y0 = y0
+        self.x_res = x_res
+        self.y_res = y_res
+        self.width = width
+        self.height = height
+        self.col0 = col0
+
+    @classmethod
+    def from_cells(cls, x, y, resolution=None):
+        """
+        Grid spanning the given cell centers; the resolution is inferred from the smallest coordinate spacing
+        unless given as a number or an (x, y) pair
+        """
+
+        x_unique = np.unique(x)
+        y_unique = np.unique(y)
+        if resolution is None:
+            resolution = (
+                np.diff(x_unique).min() if len(x_unique) > 1 else 1.0,
+                np.diff(y_unique).min() if len(y_unique) > 1 else 1.0
+            )
+        elif np.isscalar(resolution):
+            resolution = (resolution, resolution)
+        x_res, y_res = abs(resolution[0]), abs(resolution[1])
+
+        width = int(np.rint((x_unique[-1] - x_unique[0]) / x_res)) + 1
+        height = int(np.rint((y_unique[-1] - y_unique[0]) / y_res)) + 1
+
+        return cls(x_unique[0], y_unique[0], x_res, y_res, width, height)
+
+    def indexes(self, x, y):
+        """
+        Integer (column, row) index of each cell center
+        """
+
+        col = np.rint((np.asarray(x) - self.x0) / self.x_res).astype(np.int64)
+        row = np.rint((np.asarray(y) - self.y0) / self.y_res).astype(np.int64)
+
+        return col, row
+
+    def cell_indexes(self, cell):
+        """
+        Integer (column, row) index of each flat full-grid cell index (column * height + row, as in WeightStore)
+        """
+
+        col, row = np.divmod(np.asarray(cell, dtype=np.int64), self.height)
+
+        return col - self.col0, row
+
+    def coords(self):
+        return self.x0 + self.x_res * np.arange(self.width), self.y0 + self.y_res * np.arange(self.height)
+
+    def coarse_coords(self, factor):
+        """
+        Coordinates of the factor x factor coarse grid, matching coarsen(boundary='pad'): each coarse coordinate
+        is the mean of the fine cell centers in its window, so a partial window at the end is centered on the cells
+        it actually contains
+        """
+
+        coarse = []
+        for origin, res, n in [(self.x0, self.x_res, self.width), (self.y0, self.y_res, self.height)]:
+            first = np.arange(0, n, factor)
+            last = np.minimum(first + factor, n) - 1
+            coarse.append(origin + res * (first + last) / 2)
+
+        return coarse
+
+    def coarse_shape(self, factor):
+        return -(-self.width // factor), -(-self.height // factor)
+
+    def tiles(self, factor, n_tiles):
+        """
+        Split the grid along x into up to n_tiles strips of whole factor x factor coarse cells, so no coarse cell
+        straddles two tiles. Yields (slice of coarse x indexes, CellGrid of the strip's fine cells).
+        """
+
+        n_x, _ = self.coarse_shape(factor)
+        edges = np.unique(np.linspace(0, n_x, min(n_tiles, n_x) + 1).astype(int))
+        for first, last in zip(edges[:-1], edges[1:]):
+            tile = CellGrid(self.x0 + self.x_res * first * factor, self.y0, self.x_res, self.y_res,
+                            min(last * factor, self.width) - first * factor, self.height,
+                            col0=self.col0 + first * factor)
+            yield slice(first, last), tile
+
+
+def cell_indexes(df, grid):
+    """
+    Integer (column, row) grid index of each row of df, from its flat 'cell' index if it has one (frames and
+    column dicts read from a WeightStore), otherwise from its x/y cell centers
+    """
+
+    if 'cell' in df:
+        return grid.cell_indexes(df['cell'])
+
+    return grid.indexes(df['x'], df['y'])
+
+
+def position_columns(df):
+    """
+    Columns locating the rows of df on the grid: the flat cell index or the x/y cell centers
+    """
+
+    return ['cell'] if 'cell' in df else ['x', 'y']
+
+
+def grid_cells(df, grid, columns, dtype='float64'):
+    """
+    Scatter the rows of df into a dense (x, y) xarray.Dataset on grid, one variable per column; grid cells
+    without a row are NaN, as with set_index(['x', 'y']).to_xarray()
+    """
+
+    col, row = cell_indexes(df, grid)
+    x_coords, y_coords = grid.coords()
+
+    data_vars = {}
+    for c in columns:
+        values = np.full((grid.width, grid.height), np.nan, dtype=dtype)
+        values[col, row] = df[c].values
+        data_vars[c] = (['x', 'y'], values)
+
+    return xr.Dataset(data_vars=data_vars, coords=dict(x=x_coords, y=y_coords))
+
+
+def sparse_cells(df, grid, columns, dtype='float64'):
+    """
+    The rows of df as an xarray.Dataset along a 'cell' dimension, with x and y cell center coordinates; the
+    base-resolution counterpart of grid_cells that stores only the populated cells
+    """
+
+    col, row = cell_indexes(df, grid)
+    data_vars = {c: (['cell'], np.asarray(df[c].values, dtype=dtype)) for c in columns}
+
+    return xr.Dataset(data_vars=data_vars, coords=dict(
+        x=(['cell'], grid.x0 + grid.x_res * (col + grid.col0)),
+        y=(['cell'], grid.y0 + grid.y_res * row)
+    ))
+
+
+def coarsen_cells(df, grid, factor, sum_columns=(), mean_columns=(), dtype='float64'):
+    """
+    Accumulate the rows of df straight into the coarse grid with bincount, without building the fine grid.
+    Matches gridding then coarsen(boundary='pad'): sum columns ignore NaN (empty coarse cells are 0), mean
+    columns average the non-NaN cells (empty coarse cells are NaN).
+    """
+
+    col, row = cell_indexes(df, grid)
+    n_x, n_y = grid.coarse_shape(factor)
+    coarse_index = (col // factor) * n_y + (row // factor)
+    x_coords, y_coords = grid.coarse_coords(factor)
+
+    data_vars = {}
+    for c in list(sum_columns) + list(mean_columns):
+        values = df[c].values.astype('float64')
+        valid = ~np.isnan(values)
+        totals = np.bincount(coarse_index[valid], weights=values[valid], minlength=n_x * n_y)
+        if c in mean_columns:
+            counts = np.bincount(coarse_index[valid], minlength=n_x * n_y)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                totals = np.where(counts > 0, totals / counts, np.nan)
+        data_vars[c] = (['x', 'y'], totals.reshape(n_x, n_y).astype(dtype))
+
+    return xr.Dataset(data_vars=data_vars, coords=dict(x=x_coords, y=y_coords))
+
+
+def coarsen_tiles(tiles, grid, factor, sum_columns=(), mean_columns=(), dtype='float64'):
+    """
+    coarsen_cells for a frame arriving in (coarse x slice, tile CellGrid, tile frame) pieces, as from
+    CellGrid.tiles. Each tile is coarsened and streamed into the full coarse grid as it arrives. Every coarse cell
+    is summed from the same rows in the same order as the untiled path, so the results are identical.
+    """
+
+    n_x, n_y = grid.coarse_shape(factor)
+    columns = list(sum_columns) + list(mean_columns)
+    values = {c: np.empty((n_x, n_y), dtype=dtype) for c in columns}
+
+    for coarse_x, tile, tile_df in tiles:
+        tile_xr = coarsen_cells(tile_df, tile, factor, sum_columns=sum_columns, mean_columns=mean_columns,
+                                dtype=dtype)
+        for c in columns:
+            values[c][coarse_x, :] = tile_xr[c].values
+
+    x_coords, y_coords = grid.coarse_coords(factor)
+
+    return xr.Dataset(data_vars={c: (['x', 'y'], values[c]) for c in columns}, coords=dict(x=x_coords, y=y_coords))
+
+
+def coarsen_level(level_xr, factor):
+    """
+    Next pyramid level: factor x factor block sums of level_xr, with a partial block at the end as with
+    coarsen_cells
+    """
+
+    return level_xr.coarsen(x=factor, y=factor, boundary='pad').sum()
+
+
+def level_name(resolution):
+    """
+    Label of a pyramid level by its cell size in arcseconds, e.g. "ALL_30arcsec"
+    """
+
+    return 'ALL_{}arcsec'.format(int(round(resolution * 3600)))
+
+
+def tile_rows(df, grid, factor, n_tiles):
+    """
+    Rows of df falling in each of grid.tiles(factor, n_tiles), in their original order.
+    Yields (coarse x slice, tile CellGrid, row positions).
+    """
+
+    col, _ = cell_indexes(df, grid)
+    coarse_col = col // factor
+    order = np.argsort(coarse_col, kind='stable')
+    sorted_col = coarse_col[order]
+    del col, coarse_col
+
+    for coarse_x, tile in grid.tiles(factor, n_tiles):
+        first, last = np.searchsorted(sorted_col, [coarse_x.start, coarse_x.stop])
+        yield coarse_x, tile, order[first:last]
+
+
+def estimate_task_memory(n_rows, grid, factor, n_columns, dtype='float64', n_tiles=1):
+    """
+    Rough peak bytes for gridding one variable: the per-row frame and cell indexes, split across tiles, plus the
+    coarse output grid, which is always held in full
+    """
+
+    n_x, n_y = grid.coarse_shape(factor)
+    frame = n_rows * 8 * (n_columns + 4) / n_tiles
+    tile_order = 8 * n_rows if n_tiles > 1 else 0
+    coarse = n_x * n_y * (np.dtype(dtype).itemsize * 2 * n_columns + 16)
+
+    return int(frame + tile_order + coarse)
+
+
+class MemoryBudget:
+    """
+    Admits tasks while the sum of their estimated bytes stays within max_bytes. A task larger than the whole budget
+    is admitted only when nothing else is running.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.reserved = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self.condition:
+            while self.max_bytes is not None and self.reserved > 0 and self.reserved + nbytes > self.max_bytes:
+                self.condition.wait()
+            self.reserved += nbytes
+
+    def release(self, nbytes):
+        with self.condition:
+            self.reserved -= nbytes
+            self.condition.notify_all()
+
+
+def landscan_weight(landscan):
+    """
+    Per-cell dasymetric weights: each cell's share of its tract's total landscan population. The tract totals are
+    broadcast back to the cells with a groupby transform, and the columns are added to landscan in place rather
+    than merged onto a copy of every cell.
+    """
+
+    # get total landscan population by tract (GEOID), aligned with the cells
+    landscan['landscan_tract_total_pop'] = landscan.groupby('GEOID')['average_population'].transform('sum')
+
+    # perform weight calcuation
+    landscan['landscan_weight'] = landscan['average_population'] / landscan['landscan_tract_total_pop']
+
+    return landscan
+
+
+class WeightStore:
+    """
+    Compact dasymetric weight table, built once per LandScan version and tract vintage. Each column is stored as
+    its own .npy file and memory-mapped on open, so consumers read the columns without loading or copying them:
+    flat grid cell index (int64), GEOID code (int32, with a GEOID lookup table), average population and weight
+    (float32). The grid definition, the source it was built from and the LandScan version and tract vintage it
+    was built for are kept in metadata.json.
+    """
+
+    columns = {'cell': 'int64', 'geoid_code': 'int32', 'average_population': 'float32', 'landscan_weight': 'float32'}
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'metadata.json')) as f:
+            self.metadata = json.load(f)
+        self.grid = CellGrid(**self.metadata['grid'])
+        self.geoids = np.load(os.path.join(path, 'geoids.npy'))
+        for c in self.columns:
+            setattr(self, c, np.load(os.path.join(path, '{}.npy'.format(c)), mmap_mode='r'))
+
+    @classmethod
+    def build(cls, landscan, path, source=None, landscan_version=None, tract_vintage=None):
+        """
+        Compute the weights for landscan and write the store to path
+        """
+
+        os.makedirs(path, exist_ok=True)
+
+        weighted_landscan = landscan if 'landscan_weight' in landscan.columns else landscan_weight(landscan)
+        grid = CellGrid.from_cells(weighted_landscan['x'].values, weighted_landscan['y'].values)
+        col, row = grid.indexes(weighted_landscan['x'].values, weighted_landscan['y'].values)
+        geoid_code, geoids = pd.factorize(weighted_landscan['GEOID'])
+
+        arrays = {
+            'cell': col * grid.height + row,
+            'geoid_code': geoid_code,
+            'average_population': weighted_landscan['average_population'].values,
+            'landscan_weight': weighted_landscan['landscan_weight'].values,
+        }
+        for c, dtype in cls.columns.items():
+            np.save(os.path.join(path, '{}.npy'.format(c)), np.asarray(arrays[c], dtype=dtype))
+        np.save(os.path.join(path, 'geoids.npy'), np.asarray(geoids, dtype=str))
+
+        metadata = dict(
+            grid={k: float(v) if k not in ('width', 'height', 'col0') else int(v) for k, v in vars(grid).items()},
+            source=source,
+            source_mtime=os.path.getmtime(source) if source is not None else None,
+            landscan_version=landscan_version,
+            tract_vintage=tract_vintage
         )
+        with open(os.path.join(path, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f, indent=2)
+
+        return cls(path)
+
+    def is_current(self, source, landscan_version=None, tract_vintage=None):
+        """
+        True if the store was built from source for the same LandScan version and tract vintage, and source has not
+        changed since
+        """
+
+        return (self.metadata['source'] == source and self.metadata['source_mtime'] == os.path.getmtime(source) and
+                self.metadata['landscan_version'] == landscan_version and
+                self.metadata['tract_vintage'] == tract_vintage)
+
+    def xy(self):
+        """
+        Cell center coordinates, recovered from the flat grid cell index
+        """
+
+        col, row = np.divmod(self.cell, self.grid.height)
+
+        return self.grid.x0 + self.grid.x_res * col, self.grid.y0 + self.grid.y_res * row
+
+    def weighted_landscan(self, rows=None):
+        """
+        The weights of the cells at positions rows (all cells if None) as an AnnualSVI weighted landscan frame,
+        located by the flat cell index and indexed by a categorical GEOID. Only the selected rows are read from
+        the memory maps, so out-of-core runs build one tile's frame at a time.
+        """
+
+        def read(column):
+            values = getattr(self, column)
+            return np.asarray(values if rows is None else values[rows])
+
+        geoid = pd.CategoricalIndex(pd.Categorical.from_codes(read('geoid_code'), categories=self.geoids),
+                                    name='GEOID')
+
+        return pd.DataFrame({
+            'cell': read('cell'),
+            'average_population': read('average_population'),
+            'landscan_weight': read('landscan_weight')
+        }, index=geoid)
+
+
+def zarr_major_version():
+
+    return int(zarr.__version__.split('.')[0])
+
+
+def default_zarr_compressor():
+    """
+    zstd Blosc with bit shuffling, as a zarr 3 codec or (for zarr 2) a numcodecs compressor
+    """
+
+    if zarr_major_version() >= 3:
+        from zarr.codecs import BloscCodec
+        return BloscCodec(cname='zstd', clevel=3, shuffle='bitshuffle')
+
+    from numcodecs import Blosc
+    return Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
+
+
+def require_zarr_group(path):
+    """
+    Open the zarr group at path, creating it if needed; safe when other processes create the same group at once
+    """
+
+    try:
+        return zarr.open_group(path, mode='a')
+    except zarr.errors.ContainsGroupError:
+        # another writer created it between our existence check and our metadata write
+        return zarr.open_group(path, mode='r+')
+
+
+def process_alive(pid):
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+class ZarrStore:
+    """
+    One chunked, compressed Zarr store holding every gridded (variable, year) as the group <variable>/<year>.
+    Each group is written in full to a private temporary directory and moved into place with one rename, then
+    recorded in the manifest, a directory of one small JSON file per completed (variable, year). A group left by
+    a killed job is never in the manifest, so it is rewritten on resume, and staging directories left by killed
+    processes on this host are removed when the store is opened. Concurrent writers share only the root and
+    <variable> groups, whose creation tolerates a race; each (variable, year) is staged and renamed on its own, so
+    writes need no locking. Works with zarr 2 (format 2 stores) and zarr 3 (format 3 stores).
+    compressor: a numcodecs compressor with zarr 2, a zarr.codecs codec with zarr 3 (default zstd Blosc)
+    """
+
+    def __init__(self, path, chunk_size=512, compressor=None):
+        if zarr is None:
+            raise ImportError('ZarrStore requires the zarr package')
+        self.path = path
+        self.chunk_size = chunk_size
+        self.compressor = compressor if compressor is not None else default_zarr_compressor()
+        self.manifest_path = os.path.join(path, 'manifest')
+        self.tmp_path = os.path.join(path, 'tmp')
+        require_zarr_group(path)
+        os.makedirs(self.manifest_path, exist_ok=True)
+        os.makedirs(self.tmp_path, exist_ok=True)
+        self.clear_stale_tmp()
+
+    def clear_stale_tmp(self):
+        """
+        Remove staging directories (<host>.<pid>.<uuid>) of processes on this host that are no longer running
+        """
+
+        host = socket.gethostname()
+        for name in os.listdir(self.tmp_path):
+            parts = name.rsplit('.', 2)
+            if len(parts) == 3 and parts[0] == host and parts[1].isdigit() and not process_alive(int(parts[1])):
+                shutil.rmtree(os.path.join(self.tmp_path, name), ignore_errors=True)
+
+    def manifest_entry(self, variable, year):
+        return os.path.join(self.manifest_path, '{}.{}.json'.format(variable, year))
+
+    def is_complete(self, variable, year):
+        return os.path.exists(self.manifest_entry(variable, year))
+
+    def completed(self):
+        """
+        Set of (variable, year) pairs committed to the store
+        """
+
+        pairs = set()
+        for name in os.listdir(self.manifest_path):
+            if name.endswith('.json'):
+                with open(os.path.join(self.manifest_path, name)) as f:
+                    entry = json.load(f)
+                pairs.add((entry['variable'], entry['year']))
+
+        return pairs
+
+    def write(self, dataset, variable, year):
+        """
+        Commit dataset as the (variable, year) group, replacing any partial group left by an earlier run
+        """
+
+        year = str(year)
+        tmp_group = os.path.join(self.tmp_path,
+                                 '{}.{}.{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex))
+        # zarr 3 takes a list of compressors; zarr 2 takes a single compressor
+        if zarr_major_version() >= 3:
+            compression = {'compressors': [self.compressor]}
+        else:
+            compression = {'compressor': self.compressor}
+        encoding = {v: dict(chunks=self.chunks(dataset[v]), **compression) for v in dataset.data_vars}
+        dataset.to_zarr(tmp_group, mode='w', encoding=encoding, consolidated=True)
+
+        require_zarr_group(os.path.join(self.path, variable))
+        group_path = os.path.join(self.path, variable, year)
+        if os.path.exists(group_path):
+            shutil.rmtree(group_path)
+        os.rename(tmp_group, group_path)
+
+        entry = dict(variable=variable, year=year, data_vars=list(dataset.data_vars), committed=time.time())
+        entry_path = self.manifest_entry(variable, year)
+        with open(entry_path + '.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.replace(entry_path + '.tmp', entry_path)
+
+    def chunks(self, data_array):
+        """
+        chunk_size along each (x, y) axis, or the same number of values per chunk for sparse (cell) variables
+        """
+
+        edge = self.chunk_size if data_array.ndim > 1 else self.chunk_size ** 2
+
+        return tuple(min(edge, n) for n in data_array.shape)
+
+    def open(self, variable, year):
+        """
+        Lazily open one committed (variable, year) group
+        """
+
+        return xr.open_zarr(os.path.join(self.path, variable, str(year)), consolidated=True)
+
+
+class SharedLandscan:
+    """
+    LandScan cells, tract weights and cell grid loaded once and shared by every AnnualSVI year. The weights depend
+    only on LandScan and the tracts, not on the SVI year. With weight_store_path, the weights are read from a
+    WeightStore built from the same landscan file, or computed once and saved there for the next run. The store's
+    memory-mapped columns are then the working copy (weight_store), and weighted_landscan is None.
+    landscan_version, tract_vintage: recorded in the weight store; a store built for another version or vintage
+        is rebuilt
+    """
+
+    def __init__(self, landscan_path, weight_store_path=None, landscan_version=None, tract_vintage=None):
+        self.weight_store = None
+        self.weighted_landscan = None
+        if weight_store_path is not None and os.path.exists(os.path.join(weight_store_path, 'metadata.json')):
+            store = WeightStore(weight_store_path)
+            if store.is_current(landscan_path, landscan_version=landscan_version, tract_vintage=tract_vintage):
+                print('Using weight store {}'.format(weight_store_path))
+                self.grid = store.grid
+                self.weight_store = store
+                return
+
+        with instrumentation.stage('svi.load_landscan', shared=True) as record:
+            landscan = landscan_weight(read_parquet(landscan_path))
+            record['rows'] = len(landscan)
+        if weight_store_path is not None:
+            # work from the new store, so this run and later runs use the same stored weights
+            self.weight_store = WeightStore.build(landscan, weight_store_path, source=landscan_path,
+                                                  landscan_version=landscan_version, tract_vintage=tract_vintage)
+            self.grid = self.weight_store.grid
+            return
+        self.grid = CellGrid.from_cells(landscan['x'].values, landscan['y'].values)
+        self.weighted_landscan = landscan.set_index('GEOID')
 
 
 class AnnualSVI:
 
-    def __init__(self, db_path, landscan_path, year, save_template):
-        self.conn = sqlite3.connect(db_path)
-        self.landscan = read_parquet(landscan_path)
+    def __init__(self, db_path, landscan_path, year, save_template, grid_dtype='float64', shared_landscan=None,
+                 db_cache_dir=None, output_store=None, tiles=None):
+        self.db = DemographicsDB(db_path, cache_dir=db_cache_dir)
+        self.output_store = ZarrStore(output_store) if isinstance(output_store, str) else output_store
         self.year = year
         self.save_template = save_template
-        self.weighted_landscan = self.annual_landscan_weight()
-        self.svi_wide, self.dollars_wide = self.annual_svi()
-        self.weighted_svi, self.weighted_dollars = self.annual_svi_weighted_landscan()
+        self.grid_dtype = grid_dtype
+        self.weight_store = None
+        if shared_landscan is None:
+            with instrumentation.stage('svi.load_landscan', year=year) as record:
+                self.landscan = read_parquet(landscan_path)
+                self.grid = CellGrid.from_cells(self.landscan['x'].values, self.landscan['y'].values)
+                self.weighted_landscan = self.annual_landscan_weight()
+                record['rows'] = len(self.landscan)
+        else:
+            self.landscan = None
+            self.grid = shared_landscan.grid
+            self.weighted_landscan = shared_landscan.weighted_landscan
+            self.weight_store = shared_landscan.weight_store
+        with instrumentation.stage('svi.annual_svi', year=year) as record:
+            self.svi_wide, self.dollars_wide = self.annual_svi()
+            record['rows'] = len(self.svi_wide)
+        # with tiles, the SVI columns are joined onto the cells one tile at a time by process_out_of_core
+        self.tiles = tiles
+        if tiles is None:
+            with instrumentation.stage('svi.weighted_landscan', year=year) as record:
+                self.weighted_svi, self.weighted_dollars = self.annual_svi_weighted_landscan()
+                record['rows'] = len(self.weighted_svi)
+        else:
+            self.weighted_svi, self.weighted_dollars = None, None
         self.mapping = self.generate_mapping()
 
     def generate_mapping(self):
 
-        units = pd.read_sql_query("""select * from display_data;""", self.conn)
+        units = self.db.display_data()
         units_totals = {
             'persons commuting': 'TOTAL_COMMUTE_POP',
             'persons': 'TOTPOP',
@@ -51,90 +671,104 @@ class AnnualSVI:
 
     def annual_svi(self):
 
-        svi_query = f"""select * from demographics d \
-            join display_data dd on d.DEMOGRAPHICS_NAME = dd.NAME \
-            where d.UNITS = 'count' and \
-                d.YEAR = {self.year} and \
-                d.GEOTYPE = 'tract' and \
-                dd.UNITS in ('persons commuting', 'persons', 'households', 'housholds', 'housing units', 'housing structures')
-            """
+        svi_wide = self.db.wide_table(self.year, 'tract', units='count', display_units=COUNT_UNITS)
+        dollars_wide = self.db.wide_table(self.year, 'tract', names=DOLLAR_COLUMNS)
 
-        dollars_query = f"""select * from demographics d \
-            join display_data dd on d.DEMOGRAPHICS_NAME = dd.NAME \
-            where d.YEAR = {self.year} and \
-                d.GEOTYPE = 'tract' and \
-                d.DEMOGRAPHICS_NAME in ('MEDIAN_GROSS_RENT_PCT_HH_INCOME', 'PCI')
-            """
+        return svi_wide, dollars_wide
 
-        svi = pd.read_sql_query(svi_query, self.conn)
-        dollars = pd.read_sql_query(dollars_query, self.conn)
 
-        svi_wide = pd.pivot(svi, index='GEOID', columns='DEMOGRAPHICS_NAME', values='VALUE').reset_index()
-        dollars_wide = pd.pivot(dollars, index='GEOID', columns='DEMOGRAPHICS_NAME', values='VALUE').reset_index()
+    def annual_landscan_weight(self):
 
-        return svi_wide, dollars_wide
+        return landscan_weight(self.landscan)
 
+    def landscan_cells(self):
+        """
+        The landscan cells' grid positions, for tile_rows: the memory-mapped cell index of the weight store, or
+        the weighted landscan frame
+        """
 
-    def annual_landscan_weight(self):
+        if self.weight_store is not None:
+            return {'cell': self.weight_store.cell}
 
-        # get total landscan population by tract (GEOID)
-        rdf_grouped = self.landscan.groupby('GEOID').sum('average_population').reset_index()
-        rdf_grouped = rdf_grouped[['GEOID', 'average_population']].rename(
-            columns={'average_population': 'landscan_tract_total_pop'})
+        return self.weighted_landscan
 
-        # one-to-many join to set up weight calculation
-        weighted_landscan = pd.merge(self.landscan, rdf_grouped, left_on='GEOID', right_on='GEOID', how='left')
+    def n_cells(self):
 
-        # perform weight calcuation
-        weighted_landscan['landscan_weight'] = weighted_landscan['average_population'] / weighted_landscan['landscan_tract_total_pop']
+        if self.weight_store is not None:
+            return len(self.weight_store.cell)
 
-        return weighted_landscan
+        return len(self.weighted_landscan)
 
-    def annual_svi_weighted_landscan(self):
+    def annual_svi_weighted_landscan(self, rows=None):
+        """
+        Join the tract SVI and dollar columns onto the landscan cells, or onto the cells at positions rows
+        """
 
-        self.weighted_landscan = self.weighted_landscan.set_index('GEOID')
+        if self.weight_store is not None:
+            weighted_landscan = self.weight_store.weighted_landscan(rows)
+        else:
+            # shared weights arrive already indexed by GEOID
+            if 'GEOID' in self.weighted_landscan.columns:
+                self.weighted_landscan = self.weighted_landscan.set_index('GEOID')
+            weighted_landscan = self.weighted_landscan if rows is None else self.weighted_landscan.iloc[rows]
 
         svi_wide_indexed = self.svi_wide.set_index('GEOID')
         dollars_wide_indexed = self.dollars_wide.set_index('GEOID')
 
-        weighted_svi = pd.merge(self.weighted_landscan, svi_wide_indexed, left_index=True, right_index=True, how='left')
+        weighted_svi = pd.merge(weighted_landscan, svi_wide_indexed, left_index=True, right_index=True, how='left')
 
         # we don't need the weights for dollars, but we do the merge here for consistency of workflow
         # PCI and median hh rent as income pct are one-to-many joined with landscan;
         # landscan columns will be dropped and those variables will be averaged when xarray is coarsened
-        weighted_dollars = pd.merge(self.weighted_landscan, dollars_wide_indexed, left_index=True, right_index=True, how='left')
+        weighted_dollars = pd.merge(weighted_landscan, dollars_wide_indexed, left_index=True, right_index=True, how='left')
 
         return weighted_svi, weighted_dollars
 
-    def svi_xarray(self, svi_column, total_column):
+    def svi_xarray(self, svi_column, total_column, n_tiles=1):
 
-        total = '{}_corrected'
-        counts = '{}_LANDSCAN_COUNT'
-        percents = '{}_LANDSCAN_PERCENT'
+        total = CORRECTED_TOTAL
+        counts = LANDSCAN_COUNT
+        percents = LANDSCAN_PERCENT
 
-        # subset the data and calculate the landscan count estimate
-        try:
-            data_subset = self.weighted_svi[['x', 'y', 'landscan_weight', svi_column, total_column]].reset_index()
-        except KeyError:
+        if svi_column not in self.weighted_svi.columns or total_column not in self.weighted_svi.columns:
             print('Variable {} not in data for year {}'.format(svi_column, self.year))
             return
-        data_subset[counts.format(svi_column)] = data_subset['landscan_weight'] * (data_subset[svi_column])
-        data_subset[total.format(total_column)] = data_subset['landscan_weight'] * data_subset[total_column]
+        sum_columns = [svi_column, counts.format(svi_column), total.format(total_column)]
+
+        def svi_subset(rows=None):
+            # subset the data and calculate the landscan count estimate
+            weighted_svi = self.weighted_svi if rows is None else self.weighted_svi.iloc[rows]
+            data_subset = weighted_svi[position_columns(weighted_svi) + ['landscan_weight', svi_column,
+                                                                        total_column]].reset_index()
+            data_subset[counts.format(svi_column)] = data_subset['landscan_weight'] * (data_subset[svi_column])
+            data_subset[total.format(total_column)] = data_subset['landscan_weight'] * data_subset[total_column]
+            return data_subset
 
-        # set index, drop unnecessary columns, and convert to xarray
-        data_subset = data_subset.drop(['GEOID', 'landscan_weight', total_column], axis=1)
-        data_subset = data_subset.set_index(['x', 'y'])
-        data_subset_xr = data_subset.to_xarray()
+        check_columns = [svi_column, counts.format(svi_column)]
 
-        # coarsen from 3 to 30 arcsecond resolution
-        data_subset_xr_30arcsec = data_subset_xr.coarsen(
-            boundary='pad',
-            x=10,
-            y=10,
-        ).sum().compute()
+        if n_tiles == 1:
+            data_subset = svi_subset()
+            # scatter the cells straight onto the 30 arcsecond grid, skipping the 3 arcsecond grid
+            data_subset_xr_30arcsec = coarsen_cells(data_subset, self.grid, COARSEN_FACTOR, sum_columns=sum_columns,
+                                                    dtype=self.grid_dtype)
+            fine_totals = data_subset
+        else:
+            # build and scatter the subset one strip of coarse cells at a time, keeping the totals for the check
+            tile_totals = {c: [] for c in check_columns}
+
+            def svi_tiles():
+                for coarse_x, tile, rows in tile_rows(self.weighted_svi, self.grid, COARSEN_FACTOR, n_tiles):
+                    tile_subset = svi_subset(rows)
+                    for c in check_columns:
+                        tile_totals[c].append(np.nansum(tile_subset[c].values.astype('float64')))
+                    yield coarse_x, tile, tile_subset
+
+            data_subset_xr_30arcsec = coarsen_tiles(svi_tiles(), self.grid, COARSEN_FACTOR, sum_columns=sum_columns,
+                                                    dtype=self.grid_dtype)
+            fine_totals = pd.DataFrame(tile_totals)
 
         # quick sanity check on total average and landscan estimate populations across resolutions
-        sanity_check(data_subset_xr, data_subset_xr_30arcsec, columns=[svi_column, counts.format(svi_column)])
+        sanity_check(fine_totals, data_subset_xr_30arcsec, columns=check_columns, rtol=self.sanity_rtol())
 
         # calculate landscan percent
         landscan_pct = data_subset_xr_30arcsec[counts.format(svi_column)] / data_subset_xr_30arcsec[total.format(total_column)]
@@ -144,66 +778,443 @@ class AnnualSVI:
         data_subset_xr_30arcsec = data_subset_xr_30arcsec.drop_vars([svi_column])
         data_subset_xr_30arcsec = data_subset_xr_30arcsec.where(data_subset_xr_30arcsec > 0)
 
-        data_subset_xr_30arcsec.to_netcdf(path=self.save_template.format(svi_column, self.year))
+        self.save(data_subset_xr_30arcsec, svi_column)
+
+        return
+
+    def dollars_xarray(self, dollar_column, n_tiles=1):
+
+        # NaN values (and grid cells without data) are ignored in the mean calculation
+        if n_tiles == 1:
+            tract_dollars_xr_coarse = coarsen_cells(
+                self.weighted_dollars,
+                self.grid,
+                COARSEN_FACTOR,
+                mean_columns=[dollar_column],
+                dtype=self.grid_dtype
+            )
+        else:
+            dollar_subset = self.weighted_dollars[position_columns(self.weighted_dollars) + [dollar_column]]
+            tract_dollars_xr_coarse = coarsen_tiles(
+                ((coarse_x, tile, dollar_subset.iloc[rows])
+                 for coarse_x, tile, rows in tile_rows(self.weighted_dollars, self.grid, COARSEN_FACTOR, n_tiles)),
+                self.grid,
+                COARSEN_FACTOR,
+                mean_columns=[dollar_column],
+                dtype=self.grid_dtype
+            )
+
+        self.save(tract_dollars_xr_coarse, dollar_column)
 
         return
 
-    def dollars_xarray(self, dollar_column):
+    def save(self, dataset, variable):
+        """
+        Write a gridded variable to the output store if there is one, otherwise to its save_template netCDF file
+        """
+
+        with instrumentation.stage('svi.save', year=self.year, variable=variable,
+                                   cells=int(np.prod(list(dataset.sizes.values())))):
+            if self.output_store is not None:
+                self.output_store.write(dataset, variable, self.year)
+            else:
+                dataset.to_netcdf(path=self.save_template.format(variable, self.year))
+
+    def is_saved(self, variable):
+
+        if self.output_store is not None:
+            return self.output_store.is_complete(variable, self.year)
+
+        return os.path.exists(self.save_template.format(variable, self.year))
+
+    def sanity_rtol(self):
+        return 1e-5 if np.dtype(self.grid_dtype) == np.float32 else None
+
+    def svi_variables(self):
+        """
+        (svi column, total column) pairs to grid for this year, skipping the "total" columns themselves
+        """
+
+        return [(key, value) for key, value in self.mapping.items() if key != value]
+
+    def batch_variables(self):
+        """
+        SVI (svi column, total column) pairs and dollar columns present in this year's data
+        """
+
+        svi_variables = []
+        for svi_column, total_column in self.svi_variables():
+            if svi_column in self.svi_wide.columns and total_column in self.svi_wide.columns:
+                svi_variables.append((svi_column, total_column))
+            else:
+                print('Variable {} not in data for year {}'.format(svi_column, self.year))
+        dollar_columns = [d for d in DOLLAR_COLUMNS if d in self.dollars_wide.columns]
+
+        return svi_variables, dollar_columns
+
+    def batch_frame(self, weighted_svi, weighted_dollars, svi_variables, dollar_columns):
+        """
+        Cell positions, landscan count and corrected total columns for svi_variables and the dollar columns in
+        one frame; returns the frame and its sum columns
+        """
+
+        # all estimate columns in one frame; each corrected total is computed once however many variables share it
+        weight = weighted_svi['landscan_weight'].values
+        positions = position_columns(weighted_svi)
+        columns = {c: weighted_svi[c].values for c in positions}
+        for svi_column, total_column in svi_variables:
+            columns[LANDSCAN_COUNT.format(svi_column)] = weight * weighted_svi[svi_column].values
+            columns[CORRECTED_TOTAL.format(total_column)] = weight * weighted_svi[total_column].values
+        sum_columns = [c for c in columns if c not in positions]
+
+        # weighted_svi and weighted_dollars are left joins onto the same landscan rows, so the rows line up
+        for d in dollar_columns:
+            columns[d] = weighted_dollars[d].values
+
+        return pd.DataFrame(columns), sum_columns
+
+    def finish_batch(self, batch_xr_30arcsec, svi_variables, dollar_columns):
+        """
+        Calculate landscan percents and mask the cells with values of "0"
+        """
+
+        for svi_column, total_column in svi_variables:
+            batch_xr_30arcsec[LANDSCAN_PERCENT.format(svi_column)] = \
+                batch_xr_30arcsec[LANDSCAN_COUNT.format(svi_column)] / batch_xr_30arcsec[CORRECTED_TOTAL.format(total_column)]
+        estimates = [v for v in batch_xr_30arcsec.data_vars if v not in dollar_columns]
+        batch_xr_30arcsec.update(batch_xr_30arcsec[estimates].where(batch_xr_30arcsec[estimates] > 0))
+
+        return batch_xr_30arcsec
+
+    def svi_batch(self, save_path=None):
+        """
+        Grid every SVI variable and dollar variable for the year in one pass: compute all landscan count and
+        corrected total columns in one frame, scatter every variable straight onto the 30 arcsecond grid and
+        save it as the variable "ALL" (or to save_path, a netCDF file). Produces the same variables as svi_xarray
+        and dollars_xarray.
+        """
+
+        svi_variables, dollar_columns = self.batch_variables()
+        with instrumentation.stage('svi.batch', year=self.year, rows=len(self.weighted_svi),
+                                   variables=len(svi_variables) + len(dollar_columns)):
+            batch, sum_columns = self.batch_frame(self.weighted_svi, self.weighted_dollars, svi_variables,
+                                                  dollar_columns)
 
-        tract_dollars = self.weighted_dollars.set_index(['x', 'y'])[[dollar_column]]
+            # coarsen every variable together, indexing the cells into the grid once
+            batch_xr_30arcsec = coarsen_cells(
+                batch,
+                self.grid,
+                COARSEN_FACTOR,
+                sum_columns=sum_columns,
+                mean_columns=dollar_columns,
+                dtype=self.grid_dtype
+            )
 
-        # converting the sparse dataframe will fill in the empty values with NaN
-        # NaN values are ignored in the mean calculation
-        tract_dollars_xr = tract_dollars.to_xarray()
-        tract_dollars_xr_coarse = tract_dollars_xr.coarsen(
-            boundary='pad',
-            x=10,
-            y=10,
-        ).mean(skipna=True).compute()
+            # quick sanity check on landscan estimate populations across resolutions
+            sanity_check(batch, batch_xr_30arcsec, columns=sum_columns, rtol=self.sanity_rtol())
 
-        tract_dollars_xr_coarse.to_netcdf(path=self.save_template.format(dollar_column, self.year))
+            batch_xr_30arcsec = self.finish_batch(batch_xr_30arcsec, svi_variables, dollar_columns)
+
+        if save_path is not None:
+            batch_xr_30arcsec.to_netcdf(path=save_path)
+        else:
+            self.save(batch_xr_30arcsec, 'ALL')
 
         return
 
-    def process(self):
+    def svi_pyramid(self, factors=None, include_base=True):
+        """
+        Grid every SVI and dollar variable at several resolutions in one pass: the 3 arcsecond base cells are
+        scattered once, and each coarser level is block-summed from the level before it. Counts and corrected
+        totals are summed; dollar values are carried as sums and cell counts so every level averages the base
+        cells. Each level is saved as the variable level_name(resolution), so one store holds every zoom level.
+        Levels are computed in grid_dtype. The 3 arcsecond base level is saved sparse (see sparse_cells): a dense
+        state grid at that resolution would hold hundreds of millions of mostly empty cells per column.
+        factors: coarsening factor of each level relative to the previous one (default PYRAMID_FACTORS)
+        include_base: also save the 3 arcsecond base level
+        """
 
-        # process dollars
-        for d in ['MEDIAN_GROSS_RENT_PCT_HH_INCOME', 'PCI']:
-            dollar_save_path = self.save_template.format(d, self.year)
-            if os.path.exists(dollar_save_path):
-                print('Skipping already processed variable {} for year {}'.format(d, self.year))
+        if self.weighted_svi is None:
+            raise ValueError('svi_pyramid needs the in-memory weighted frames; it is not available with tiles')
+        factors = PYRAMID_FACTORS if factors is None else factors
+
+        svi_variables, dollar_columns = self.batch_variables()
+        with instrumentation.stage('svi.batch_frame', year=self.year, rows=len(self.weighted_svi)):
+            frame, sum_columns = self.batch_frame(self.weighted_svi, self.weighted_dollars, svi_variables,
+                                                  dollar_columns)
+        count_columns = [DOLLAR_COUNT.format(d) for d in dollar_columns]
+        for d, count in zip(dollar_columns, count_columns):
+            frame[count] = frame[d].notna().astype('float64')
+        level_columns = sum_columns + dollar_columns + count_columns
+
+        def save_level(level_xr, resolution):
+            # dollar averages from the carried sums and counts, then percents and masks as in svi_batch
+            level_xr = level_xr.copy()
+            for d, count in zip(dollar_columns, count_columns):
+                level_xr[d] = level_xr[d] / level_xr[count].where(level_xr[count] > 0)
+            level_xr = level_xr.drop_vars(count_columns)
+            level_xr = self.finish_batch(level_xr, svi_variables, dollar_columns).astype(self.grid_dtype, copy=False)
+            print('Saving level {} for year {}'.format(level_name(resolution), self.year))
+            self.save(level_xr, level_name(resolution))
+
+        resolution = self.grid.x_res
+        if include_base and not self.is_saved(level_name(resolution)):
+            save_level(sparse_cells(frame, self.grid, level_columns, dtype=self.grid_dtype), resolution)
+
+        # the first level is scattered straight from the cells; later levels come from the level before
+        with instrumentation.stage('svi.pyramid_level', year=self.year, factor=factors[0], rows=len(frame)):
+            level_xr = coarsen_cells(frame, self.grid, factors[0], sum_columns=level_columns, dtype=self.grid_dtype)
+            sanity_check(frame, level_xr, columns=sum_columns, rtol=self.sanity_rtol())
+        resolution *= factors[0]
+        total_factor = factors[0]
+        for i, factor in enumerate(factors):
+            if i > 0:
+                previous_xr = level_xr
+                with instrumentation.stage('svi.pyramid_level', year=self.year, factor=factor,
+                                           cells=previous_xr.sizes['x'] * previous_xr.sizes['y']):
+                    level_xr = coarsen_level(previous_xr, factor)
+                    sanity_check(previous_xr, level_xr, columns=sum_columns, rtol=self.sanity_rtol())
+                resolution *= factor
+                total_factor *= factor
+                # the blocks nest, so each level covers the same base cells as coarsening the base grid directly
+                x_coords, y_coords = self.grid.coarse_coords(total_factor)
+                level_xr = level_xr.assign_coords(x=x_coords, y=y_coords)
+            if not self.is_saved(level_name(resolution)):
+                save_level(level_xr, resolution)
+
+        return
+
+    def process_out_of_core(self, n_tiles, batch=False):
+        """
+        Grid the year in n_tiles strips of whole coarse cells without the full weighted_svi and weighted_dollars
+        merges: each strip's landscan cells are joined to the tract data, coarsened for every pending variable at
+        once and streamed into the output grid before the next strip is joined. Only the coarse grids and the
+        landscan cell table are held in full. The outputs are identical to the in-memory path.
+        """
+
+        svi_variables, dollar_columns = self.batch_variables()
+        if batch:
+            if self.is_saved('ALL'):
+                print('Skipping already processed year {}'.format(self.year))
+                return
+            print('Processing all variables for year {} in {} tiles'.format(self.year, n_tiles))
+        else:
+            for variable in dollar_columns + [svi_column for svi_column, _ in svi_variables]:
+                if self.is_saved(variable):
+                    print('Skipping already processed variable {} for year {}'.format(variable, self.year))
+            dollar_columns = [d for d in dollar_columns if not self.is_saved(d)]
+            svi_variables = [(svi_column, total_column) for svi_column, total_column in svi_variables
+                             if not self.is_saved(svi_column)]
+            print('Processing {} variables for year {} in {} tiles'.format(
+                len(dollar_columns) + len(svi_variables), self.year, n_tiles))
+        if not svi_variables and not dollar_columns:
+            return
+
+        sum_columns = list(dict.fromkeys(
+            c for svi_column, total_column in svi_variables
+            for c in (LANDSCAN_COUNT.format(svi_column), CORRECTED_TOTAL.format(total_column))
+        ))
+        tile_totals = {c: [] for c in sum_columns}
+
+        def batch_tiles():
+            for coarse_x, tile, rows in tile_rows(self.landscan_cells(), self.grid, COARSEN_FACTOR, n_tiles):
+                weighted_svi, weighted_dollars = self.annual_svi_weighted_landscan(rows)
+                tile_batch, _ = self.batch_frame(weighted_svi, weighted_dollars, svi_variables, dollar_columns)
+                del weighted_svi, weighted_dollars
+                for c in sum_columns:
+                    tile_totals[c].append(np.nansum(tile_batch[c].values.astype('float64')))
+                yield coarse_x, tile, tile_batch
+
+        with instrumentation.stage('svi.out_of_core', year=self.year, tiles=n_tiles, rows=self.n_cells(),
+                                   variables=len(svi_variables) + len(dollar_columns)):
+            batch_xr_30arcsec = coarsen_tiles(batch_tiles(), self.grid, COARSEN_FACTOR, sum_columns=sum_columns,
+                                              mean_columns=dollar_columns, dtype=self.grid_dtype)
+
+        # quick sanity check on landscan estimate populations across resolutions
+        sanity_check(pd.DataFrame(tile_totals), batch_xr_30arcsec, columns=sum_columns, rtol=self.sanity_rtol())
+
+        batch_xr_30arcsec = self.finish_batch(batch_xr_30arcsec, svi_variables, dollar_columns)
+
+        if batch:
+            self.save(batch_xr_30arcsec, 'ALL')
+            return
+
+        # split into the per-variable outputs of dollars_xarray and svi_xarray
+        for d in dollar_columns:
+            self.save(batch_xr_30arcsec[[d]], d)
+        for svi_column, total_column in svi_variables:
+            self.save(batch_xr_30arcsec[[LANDSCAN_COUNT.format(svi_column), CORRECTED_TOTAL.format(total_column),
+                                         LANDSCAN_PERCENT.format(svi_column)]], svi_column)
+
+    def task_tiles(self, n_rows, n_columns, memory_budget=None):
+        """
+        Number of tiles needed to grid one variable within memory_budget bytes, doubling the tile count until the
+        estimate fits or every tile is a single strip of coarse cells. Returns (number of tiles, estimated bytes).
+        """
+
+        n_x, _ = self.grid.coarse_shape(COARSEN_FACTOR)
+        n_tiles = 1
+        estimate = estimate_task_memory(n_rows, self.grid, COARSEN_FACTOR, n_columns, self.grid_dtype)
+        while memory_budget is not None and estimate > memory_budget and n_tiles < n_x:
+            n_tiles = min(n_tiles * 2, n_x)
+            estimate = estimate_task_memory(n_rows, self.grid, COARSEN_FACTOR, n_columns, self.grid_dtype, n_tiles)
+
+        return n_tiles, estimate
+
+    def process(self, batch=False, ncpu=1, memory_budget=None, pyramid=False):
+        """
+        Grid every variable for the year, skipping those already saved
+        batch: grid all variables in one pass with svi_batch
+        pyramid: grid all variables at every PYRAMID_FACTORS level with svi_pyramid
+        ncpu: number of variables gridded concurrently; the threads share the weighted frames without copying them
+        memory_budget: bytes the concurrent variables may use together, judged from estimate_task_memory; a
+            variable that would not fit on its own is gridded in tiles
+        """
+
+        if pyramid:
+            print('Processing pyramid levels for year {}'.format(self.year))
+            self.svi_pyramid()
+            return
+
+        if self.tiles is not None:
+            self.process_out_of_core(self.tiles, batch=batch)
+            return
+
+        if batch:
+            if self.is_saved('ALL'):
+                print('Skipping already processed year {}'.format(self.year))
             else:
-                print('Processing variable {} for year {}'.format(d, self.year))
-                self.dollars_xarray(dollar_column=d)
+                print('Processing all variables for year {}'.format(self.year))
+                self.svi_batch()
+            return
 
-        # process SVI
-        for key, value in self.mapping.items():
+        # (variable, gridding function, frame rows, frame columns)
+        tasks = []
+        for d in DOLLAR_COLUMNS:
+            if self.is_saved(d):
+                print('Skipping already processed variable {} for year {}'.format(d, self.year))
+            else:
+                tasks.append((d, partial(self.dollars_xarray, dollar_column=d), len(self.weighted_dollars), 3))
+        for key, value in self.svi_variables():
+            # skip columns that have already been processed
+            if self.is_saved(key):
+                print('Skipping already processed variable {} for year {}'.format(key, self.year))
+            else:
+                tasks.append((key, partial(self.svi_xarray, svi_column=key, total_column=value),
+                              len(self.weighted_svi), 7))
 
-            # skip the "total" columns
-            if key != value:
+        budget = MemoryBudget(memory_budget)
 
-                # skip columns that have already been processed
-                save_path = self.save_template.format(key, self.year)
-                if os.path.exists(save_path):
-                    print('Skipping already processed variable {} for year {}'.format(key, self.year))
+        def run(task):
+            variable, grid_fxn, n_rows, n_columns = task
+            n_tiles, estimate = self.task_tiles(n_rows, n_columns, memory_budget)
+            budget.acquire(estimate)
+            try:
+                if n_tiles > 1:
+                    print('Processing variable {} for year {} in {} tiles'.format(variable, self.year, n_tiles))
                 else:
-                    print('Processing variable {} for year {}'.format(key, self.year))
-                    try:
-                        self.svi_xarray(svi_column=key, total_column=value)
-                    except MemoryError:
-                        print('Memory error encountered processing variable {} for year {}'.format(key, self.year))
-                        print('Rough estimate of memory used by weighted SVI dataframe: {}'.format(sys.getsizeof(self.weighted_svi)))
+                    print('Processing variable {} for year {}'.format(variable, self.year))
+                with instrumentation.stage('svi.variable', year=self.year, variable=variable, rows=n_rows,
+                                           tiles=n_tiles, estimated_bytes=estimate):
+                    grid_fxn(n_tiles=n_tiles)
+            except MemoryError:
+                print('Memory error encountered processing variable {} for year {}'.format(variable, self.year))
+                print('Estimated memory for the variable in {} tile(s): {} bytes'.format(n_tiles, estimate))
+            finally:
+                budget.release(estimate)
 
+        with ThreadPoolExecutor(ncpu) as pool:
+            list(pool.map(run, tasks))
 
-def main(db_path, landscan_path, year, save_template):
+
+def main(db_path, landscan_path, year, save_template, batch=False, db_cache_dir=None, output_store=None,
+         variable_workers=1, memory_budget=None, tiles=None, pyramid=False, weight_store_path=None,
+         landscan_version=None, tract_vintage=None):
+
+    # with a weight store, the year reads the stored weights (building the store first if needed)
+    shared_landscan = None
+    if weight_store_path is not None:
+        shared_landscan = SharedLandscan(landscan_path, weight_store_path=weight_store_path,
+                                         landscan_version=landscan_version, tract_vintage=tract_vintage)
 
     a = AnnualSVI(
         db_path=db_path,
         landscan_path=landscan_path,
         year=year,
-        save_template=save_template
+        save_template=save_template,
+        shared_landscan=shared_landscan,
+        db_cache_dir=db_cache_dir,
+        output_store=output_store,
+        tiles=tiles
+    )
+    a.process(batch=batch, ncpu=variable_workers, memory_budget=memory_budget, pyramid=pyramid)
+
+
+# LandScan weights shared with the year workers; forked workers read the parent's copy instead of receiving one
+_shared_landscan = None
+
+
+def process_year(year, db_path, save_template, batch=False, db_cache_dir=None, output_store=None,
+                 variable_workers=1, memory_budget=None, tiles=None, pyramid=False):
+
+    a = AnnualSVI(
+        db_path=db_path,
+        landscan_path=None,
+        year=year,
+        save_template=save_template,
+        shared_landscan=_shared_landscan,
+        db_cache_dir=db_cache_dir,
+        output_store=output_store,
+        tiles=tiles
     )
-    a.process()
+    a.process(batch=batch, ncpu=variable_workers, memory_budget=memory_budget, pyramid=pyramid)
+
+    return year
+
+
+def main_years(db_path, landscan_path, years, save_template, batch=False, ncpu=1, weight_store_path=None,
+               db_cache_dir=None, output_store=None, variable_workers=1, memory_budget=None, tiles=None,
+               pyramid=False, landscan_version=None, tract_vintage=None):
+    """
+    Process several years, loading LandScan and computing the tract weights once. The per-year database pulls
+    and gridding run in a pool of forked workers that share the weight table copy-on-write. variable_workers and
+    memory_budget (or tiles) apply to each year worker separately.
+    """
+
+    global _shared_landscan
+    _shared_landscan = SharedLandscan(landscan_path, weight_store_path=weight_store_path,
+                                      landscan_version=landscan_version, tract_vintage=tract_vintage)
+
+    if db_cache_dir is not None:
+        # make the indexed local copy once, before the workers look for it
+        DemographicsDB(db_path, cache_dir=db_cache_dir).close()
+
+    if output_store is not None:
+        # create the store root and clear stale staging directories once, before the workers open it
+        ZarrStore(output_store)
+
+    year_task = partial(process_year, db_path=db_path, save_template=save_template, batch=batch,
+                        db_cache_dir=db_cache_dir, output_store=output_store, variable_workers=variable_workers,
+                        memory_budget=memory_budget, tiles=tiles, pyramid=pyramid)
+    with mp.get_context('fork').Pool(ncpu) as pool:
+        for year in pool.imap_unordered(year_task, years):
+            print('Finished year {}'.format(year))
+
+
+def parse_years(year_args):
+    """
+    Expand year arguments such as ['2011-2019'] or ['2015', '2017'] into a list of year strings
+    """
+
+    years = []
+    for arg in year_args:
+        if '-' in arg:
+            first, last = arg.split('-')
+            years.extend(str(y) for y in range(int(first), int(last) + 1))
+        else:
+            years.append(arg)
+
+    return years
 
 
 if __name__ == '__main__':
@@ -212,10 +1223,49 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--db_path', help='path to sqlite database file')
     parser.add_argument('-l', '--landscan', help='path to parquet format landscan + census tract spatial join')
-    parser.add_argument('-y', '--year', help='year of census data to process')
+    parser.add_argument('-y', '--year', nargs='+',
+                        help='year(s) of census data to process, e.g. 2019, 2015 2017 or 2011-2019')
     parser.add_argument('-s', '--save_template', help='string template for formatting save path')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='grid all variables for the year in one pass into a single file (variable name "ALL")')
+    parser.add_argument('-n', '--ncpu', type=int, default=1, help='number of years to process in parallel')
+    parser.add_argument('-w', '--weight_store', help='directory of the persistent landscan weight store')
+    parser.add_argument('--landscan_version', help='LandScan release of --landscan, e.g. 2019; a weight store built '
+                                                   'for another release is rebuilt')
+    parser.add_argument('--tract_vintage', help='census tract vintage of --landscan, e.g. 2010; a weight store '
+                                                'built for another vintage is rebuilt')
+    parser.add_argument('-c', '--db_cache', help='directory for the indexed database copy and parquet extracts')
+    parser.add_argument('-z', '--zarr_store', help='write all variables and years to this zarr store instead of '
+                                                   'one netCDF file per save_template path')
+
+    parser.add_argument('-v', '--variable_workers', type=int, default=1,
+                        help='number of variables gridded concurrently within each year')
+    parser.add_argument('-m', '--memory_budget', type=float,
+                        help='memory (GB) the concurrent variables of a year may use; larger variables are tiled')
+    parser.add_argument('-t', '--tiles', type=int,
+                        help='grid each year out of core in this many strips of coarse cells')
+    parser.add_argument('-p', '--pyramid', action='store_true',
+                        help='grid all variables at every pyramid level (variable names "ALL_<n>arcsec")')
+    parser.add_argument('--metrics', help='append per-stage timing and memory records to this JSON lines file')
 
     opts = parser.parse_args()
+    memory_budget = int(opts.memory_budget * 1e9) if opts.memory_budget is not None else None
+
+    if opts.metrics is not None:
+        # forked year workers inherit the recorder and append to the same file
+        instrumentation.configure(path=opts.metrics)
 
     # "/scratch1/06134/kpierce/landscan/{}_{}_landscan_30arcsecond_masked_xr_20211111.nc"
-    main(db_path=opts.db_path, landscan_path=opts.landscan, year=opts.year, save_template=opts.save_template)
\ No newline at end of file
+    years = parse_years(opts.year)
+    if len(years) == 1:
+        main(db_path=opts.db_path, landscan_path=opts.landscan, year=years[0], save_template=opts.save_template,
+             batch=opts.batch, db_cache_dir=opts.db_cache, output_store=opts.zarr_store,
+             variable_workers=opts.variable_workers, memory_budget=memory_budget, tiles=opts.tiles,
+             pyramid=opts.pyramid, weight_store_path=opts.weight_store, landscan_version=opts.landscan_version,
+             tract_vintage=opts.tract_vintage)
+    else:
+        main_years(db_path=opts.db_path, landscan_path=opts.landscan, years=years, save_template=opts.save_template,
+                   batch=opts.batch, ncpu=opts.ncpu, weight_store_path=opts.weight_store,
+                   db_cache_dir=opts.db_cache, output_store=opts.zarr_store,
+                   variable_workers=opts.variable_workers, memory_budget=memory_budget, tiles=opts.tiles,
+                   pyramid=opts.pyramid, landscan_version=opts.landscan_version, tract_vintage=opts.tract_vintage)
\ No newline at end of file
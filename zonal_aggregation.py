@@ -0,0 +1,233 @@
+import pandas as pd
+import numpy as np
+from scipy import sparse
+import hashlib
+import logging
+import os
+import re
+
+from landscan_census import ZoneJoiner
+
+
+class AggregationMatrix:
+    """
+    Sparse matrix rolling source units (LandScan cells or tracts) up to a target geography such as counties, DFPS
+    regions, ZCTAs, CBSAs or congressional districts. Entry (i, j) is the share of source unit j counted in target
+    zone i, so all count variables and years aggregate with one sparse matrix product. Build it once per source and
+    target pair and reuse it through cached().
+    matrix: scipy.sparse matrix of shape (number of target zones, number of source units)
+    source_ids: ids of the matrix columns, or None when the sources are cells identified by position
+    target_ids: ids of the matrix rows
+    """
+
+    def __init__(self, matrix, source_ids, target_ids, fingerprint=None):
+        self.matrix = sparse.csr_matrix(matrix)
+        self.source_ids = np.asarray(source_ids, dtype=str) if source_ids is not None else None
+        self.target_ids = np.asarray(target_ids, dtype=str)
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_cells(cls, x, y, target_shp, id_column='GEOID', crs=None):
+        """
+        Cells to the target zone containing each cell center; cells outside every zone are left out
+        target_shp: geopandas.GeoDataFrame of target zones with id_column and geometry columns
+        crs: CRS of the x/y coordinates; the zones are reprojected to it if given
+        """
+
+        joiner = ZoneJoiner(target_shp, id_column=id_column, crs=crs)
+        codes = joiner.zone_codes(x, y)
+        inside = np.flatnonzero(codes >= 0)
+        matrix = sparse.csr_matrix(
+            (np.ones(len(inside)), (codes[inside], inside)),
+            shape=(len(joiner.zone_ids), len(codes))
+        )
+
+        return cls(matrix, None, joiner.zone_ids)
+
+    @classmethod
+    def from_tracts(cls, weighted_landscan, target_shp, id_column='GEOID', crs=None):
+        """
+        Tracts to target zones, splitting each tract by where its LandScan population lives: entry (i, j) is the
+        share of tract j's population in cells inside zone i
+        weighted_landscan: cells with x, y and landscan_weight columns and the tract GEOID as a column or the
+            index, e.g. AnnualSVI.weighted_landscan (for store-backed runs, WeightStore.weighted_landscan() with x and
+            y from WeightStore.xy())
+        """
+
+        cells = cls.from_cells(weighted_landscan['x'].values, weighted_landscan['y'].values, target_shp,
+                               id_column=id_column, crs=crs)
+
+        if 'GEOID' in weighted_landscan.columns:
+            tracts = weighted_landscan['GEOID']
+        else:
+            tracts = weighted_landscan.index.to_series()
+        tract_codes, tract_ids = pd.factorize(tracts.astype(str).where(tracts.notna()))
+        in_tract = np.flatnonzero(tract_codes >= 0)
+        weights = np.nan_to_num(weighted_landscan['landscan_weight'].values.astype('float64'))
+        cell_tract = sparse.csr_matrix(
+            (weights[in_tract], (in_tract, tract_codes[in_tract])),
+            shape=(len(weighted_landscan), len(tract_ids))
+        )
+
+        return cls(cells.matrix @ cell_tract, tract_ids, cells.target_ids)
+
+    @classmethod
+    def from_crosswalk(cls, crosswalk, source_column, target_column, weight_column=None):
+        """
+        Sources to targets from a table of (source, target) rows, such as the DFPS region to county crosswalk;
+        weight_column gives the share of each source in its target (1 if not given)
+        """
+
+        source_codes, source_ids = pd.factorize(crosswalk[source_column].astype(str))
+        target_codes, target_ids = pd.factorize(crosswalk[target_column].astype(str))
+        if weight_column is None:
+            weights = np.ones(len(crosswalk))
+        else:
+            weights = crosswalk[weight_column].values.astype('float64')
+        matrix = sparse.coo_matrix((weights, (target_codes, source_codes)), shape=(len(target_ids), len(source_ids)))
+
+        return cls(matrix, source_ids, target_ids)
+
+    def then(self, other):
+        """
+        Chain this matrix with other, whose sources are this matrix's targets (e.g. tracts to counties, then
+        counties to DFPS regions)
+        """
+
+        positions = pd.Index(other.source_ids).get_indexer(self.target_ids)
+        matched = np.flatnonzero(positions >= 0)
+        select = sparse.csr_matrix(
+            (np.ones(len(matched)), (positions[matched], matched)),
+            shape=(len(other.source_ids), len(self.target_ids))
+        )
+
+        return AggregationMatrix(other.matrix @ select @ self.matrix, self.source_ids, other.target_ids)
+
+    def source_values(self, frame, columns, id_column='GEOID'):
+        """
+        (number of source units, number of columns) array of frame's columns aligned to the matrix columns;
+        sources missing from frame and NaN values count as 0, as in a groupby sum
+        """
+
+        values = np.nan_to_num(frame[columns].to_numpy(dtype='float64'))
+        if self.source_ids is None:
+            if len(frame) != self.matrix.shape[1]:
+                raise ValueError('Expected one row per cell ({} rows), got {}'.format(self.matrix.shape[1], len(frame)))
+            return values
+
+        ids = frame[id_column] if id_column in frame.columns else frame.index.to_series()
+        positions = pd.Index(self.source_ids).get_indexer(ids.astype(str))
+        aligned = np.zeros((len(self.source_ids), len(columns)))
+        matched = positions >= 0
+        np.add.at(aligned, positions[matched], values[matched])
+
+        return aligned
+
+    def aggregate(self, frame, columns, id_column='GEOID', by=None, percentages_map=None):
+        """
+        Sum columns of frame into the target zones with one sparse product, returning a frame with a GEOID
+        column of target ids
+        frame: one row per source unit (per source unit and `by` value if given), identified by id_column or the
+            index; for cell matrices, one row per cell in matrix order
+        by: optional column such as YEAR; every (column, by value) pair goes through the same product
+        percentages_map: {estimate column: total column}; adds EP_ percent columns as in dfps_agg
+        """
+
+        columns = list(columns)
+        if by is None:
+            aggregated = pd.DataFrame(self.matrix @ self.source_values(frame, columns, id_column), columns=columns)
+            aggregated.insert(0, 'GEOID', self.target_ids)
+        else:
+            wide = frame.set_index([id_column, by])[columns].unstack(by)
+            wide_columns = wide.columns
+            wide.columns = range(wide.shape[1])
+            wide = wide.reset_index()
+            values = self.matrix @ self.source_values(wide, list(wide.columns[1:]), id_column)
+            aggregated = pd.DataFrame(values, index=pd.Index(self.target_ids, name='GEOID'), columns=wide_columns)
+            aggregated = aggregated.stack(by)[columns].reset_index()
+
+        if percentages_map:
+            add_percentages(aggregated, percentages_map)
+
+        return aggregated
+
+    def save(self, path):
+
+        matrix = self.matrix.tocsr()
+        np.savez(
+            path,
+            data=matrix.data,
+            indices=matrix.indices,
+            indptr=matrix.indptr,
+            shape=np.asarray(matrix.shape),
+            source_ids=self.source_ids if self.source_ids is not None else np.asarray([], dtype=str),
+            positional=np.asarray(self.source_ids is None),
+            target_ids=self.target_ids,
+            fingerprint=np.asarray(self.fingerprint or '')
+        )
+
+    @classmethod
+    def load(cls, path):
+
+        with np.load(path) as stored:
+            matrix = sparse.csr_matrix((stored['data'], stored['indices'], stored['indptr']),
+                                       shape=tuple(stored['shape']))
+            source_ids = None if stored['positional'] else stored['source_ids']
+            return cls(matrix, source_ids, stored['target_ids'], fingerprint=str(stored['fingerprint']) or None)
+
+    @classmethod
+    def cached(cls, cache_path, fingerprint, build_fxn):
+        """
+        Load the matrix from cache_path if it was built from inputs with the same fingerprint (see
+        aggregation_fingerprint), otherwise call build_fxn() and cache the result
+        """
+
+        if cache_path is not None and os.path.exists(cache_path):
+            matrix = cls.load(cache_path)
+            if matrix.fingerprint == fingerprint:
+                logging.info(f'Using cached aggregation matrix {cache_path}')
+                return matrix
+            logging.info(f'Cached aggregation matrix {cache_path} does not match its inputs; rebuilding')
+
+        matrix = build_fxn()
+        matrix.fingerprint = fingerprint
+        if cache_path is not None:
+            matrix.save(cache_path)
+
+        return matrix
+
+
+def add_percentages(df, percentages_map):
+    """
+    Add an EP_ percent column for each {E_ estimate column: total column} pair, in place
+    """
+
+    est_re = re.compile(r'^E_')
+    for key, value in percentages_map.items():
+        if key in df.columns and value in df.columns:
+            pct_name = re.sub(est_re, 'EP_', key)
+            df[pct_name] = (df[key] / df[value]) * 100
+
+    return df
+
+
+def aggregation_fingerprint(*parts):
+    """
+    Hash of the inputs of an aggregation matrix: arrays (e.g. cell coordinates or weights), GeoDataFrames (ids and
+    geometries) and plain values such as id column names
+    """
+
+    fingerprint = hashlib.sha1()
+    for part in parts:
+        if hasattr(part, 'geometry'):
+            fingerprint.update(pd.util.hash_pandas_object(part.drop(columns=part.geometry.name)).values.tobytes())
+            for wkb in part.geometry.to_wkb():
+                fingerprint.update(wkb if wkb is not None else b'')
+        elif isinstance(part, (pd.DataFrame, pd.Series, pd.Index)):
+            fingerprint.update(pd.util.hash_pandas_object(part).values.tobytes())
+        elif isinstance(part, np.ndarray):
+            fingerprint.update(np.ascontiguousarray(part).tobytes())
+        else:
+            fingerprint.update(repr(part).encode())
+
+    return fingerprint.hexdigest()